@@ -32,6 +32,9 @@ def clear_cache():
 
   clear_dashboard_cache()
 
+  from .utils.recipients import clear_recipients_cache
+  clear_recipients_cache()
+
 
 def on_login(login_manager):
   import frappe.permissions
@@ -39,7 +39,24 @@ def serve(context, port=None, profile=False, no_reload=False, no_threading=False
          sites_path='.')
 
 
+@click.command("rebuild-device-token-index")
+@pass_context
+def rebuild_device_token_index(context):
+  "Rebuild the redis index of user device tokens from the database"
+  import frappe
+  from renovation_core.utils.device_tokens import rebuild_token_index
+
+  for site in context.sites:
+    try:
+      frappe.init(site=site)
+      frappe.connect()
+      print("{}: Indexed {} tokens".format(site, rebuild_token_index()))
+    finally:
+      frappe.destroy()
+
+
 renovation.add_command(setup)
 renovation.add_command(setup_nginx)
 renovation.add_command(serve)
+renovation.add_command(rebuild_device_token_index)
 commands = [renovation]
@@ -14,7 +14,9 @@ def before_save(doc, method):
 
 
 def on_update(doc, method):
+  from renovation_core.utils.fcm_topics import on_user_roles_change
   update_quick_login_pin(doc, doc.__new_quick_login_pin)
+  on_user_roles_change(doc)
 
 
 def update_quick_login_pin(doc, quick_login_pin):
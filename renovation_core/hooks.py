@@ -125,8 +125,14 @@ doc_events = {
         "before_save": "renovation_core.doc_events.user.before_save",
         "on_update": "renovation_core.doc_events.user.on_update",
         "on_change": [
-            "renovation_core.utils.renovation.clear_user_sidebar_cache"
-        ]
+            "renovation_core.utils.renovation.clear_user_sidebar_cache",
+            "renovation_core.utils.recipients.on_user_change"
+        ],
+        "on_trash": "renovation_core.utils.recipients.on_user_change"
+    },
+    "Role": {
+        "on_update": "renovation_core.utils.recipients.on_role_change",
+        "on_trash": "renovation_core.utils.recipients.on_role_change"
     },
     "Renovation Script": {
         "on_change": "renovation_core.utils.meta.on_renovation_script_change"
@@ -164,8 +170,19 @@ scheduler_events = {
     # 	"weekly": [
     # 		"renovation_core.tasks.weekly"
     # 	]
+    "all": [
+        "renovation_core.utils.device_tokens.flush_token_heartbeats",
+        "renovation_core.utils.hpk.refresh_huawei_auth_token",
+        "renovation_core.utils.sms_outbox.drain_pending_outboxes"
+    ],
+    "cron": {
+        "* * * * *": [
+            "renovation_core.utils.notification.drain_notification_intents"
+        ]
+    },
     "hourly": [
-        "renovation_core.utils.temporary_files.flush_files"
+        "renovation_core.utils.temporary_files.flush_files",
+        "renovation_core.utils.device_tokens.delete_expired_tokens"
     ],
     "monthly": [
         "renovation_core.tasks.generate_apple_client_secret"
@@ -2,6 +2,8 @@ import frappe
 
 def after_migrate():
   set_default_otp_template()
+  rebuild_device_token_index()
+  sync_fcm_role_topics()
 
 def set_default_otp_template():
   if not frappe.db.get_value("System Settings", None, "email_otp_template"):
@@ -13,4 +15,14 @@ def set_default_otp_template():
     if frappe.db.exists("SMS Template", "Default SMS OTP Template"):
       # should exists via fixtures
       frappe.db.set_value("System Settings", None, "sms_otp_template", "Default SMS OTP Template")
-    
\ No newline at end of file
+    
+
+def rebuild_device_token_index():
+  from renovation_core.utils.device_tokens import rebuild_token_index
+  rebuild_token_index()
+
+
+def sync_fcm_role_topics():
+  from renovation_core.utils.fcm_topics import sync_role_topics, get_topic_roles
+  if len(get_topic_roles()):
+    sync_role_topics()
@@ -3,11 +3,13 @@
 
 frappe.ui.form.on('Broadcast Message', {
     refresh: function (frm) {
-        if (frm.doc.docstatus == 1) {
-            frm.add_custom_button(__("Send Message"), () => {
+        if (frm.doc.docstatus == 1 && frm.doc.__onload && frm.doc.__onload.can_send) {
+            const resume = ["Failed", "Queued", "Sending"].includes(frm.doc.status);
+            frm.add_custom_button(resume ? __("Resume") : __("Send Message"), () => {
                 frappe.call({
                     method: "send",
-                    doc: frm.doc
+                    doc: frm.doc,
+                    callback: () => frm.reload_doc()
                 });
             });
         }
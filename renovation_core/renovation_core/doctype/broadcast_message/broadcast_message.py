@@ -5,10 +5,27 @@
 from __future__ import unicode_literals
 
 import frappe
+from frappe.model import default_fields
 from frappe.model.document import Document
+from frappe.utils import cint, now_datetime, time_diff_in_seconds
+
+# Recipients streamed and dispatched at once
+BROADCAST_PAGE_SIZE = 1000
+BROADCAST_TIMEOUT = 4 * 60 * 60
+# A Sending broadcast that has not saved its progress for this many seconds is resumable,
+# in case its worker was killed before it could mark it as Failed
+BROADCAST_HEARTBEAT_TIMEOUT = 30 * 60
+RECIPIENT_TYPES = ("users", "roles", "fcm_tokens", "fcm_topics", "emails", "mobile_nos")
+# Recipients already sent to by a broadcast, so that the ones in many targets are sent to once
+#   broadcast_message_recipients|{name}: set of {recipient type}:{recipient}
+BROADCAST_RECIPIENTS_KEY = "broadcast_message_recipients"
+BROADCAST_RECIPIENTS_EXPIRY = 7 * 24 * 60 * 60
 
 
 class BroadcastMessage(Document):
+  def onload(self):
+    self.set_onload("can_send", not self.is_running())
+
   def validate(self):
     if self.medium not in ("FCM", "SMS", "Email"):
       frappe.throw("Invalid Broadcast Medium")
@@ -28,115 +45,354 @@ class BroadcastMessage(Document):
 
   @frappe.whitelist()
   def send(self):
+    """
+    Queues the broadcast to run in the background
+    A failed or abandoned run resumes from its checkpoint, a sent broadcast starts over
+    """
+    if self.docstatus != 1:
+      frappe.throw("Broadcast Message should be submitted before it is sent")
+    if self.is_running():
+      frappe.throw("Broadcast is already being sent")
 
-    t = frappe._dict(
-        title=self.title,
-        body=self.body,
-        users=set(),
-        fcm_tokens=set(),
-        fcm_topics=set(),
-        emails=set(),
-        mobile_nos=set()
-    )
-
-    for target in self.targets:
-      if target.type == "DocType":
-        t.users.update(
-            self.get_target_users_from_docs(
-                target.target_dt, frappe.parse_json(target.filters),
-                target.user_path
-            )
-        )
-
-      elif target.type == "CMD":
-        cmd_r = frappe.get_attr(target.cmd)()
-        for p in ["users", "fcm_tokens", "fcm_topics", "emails", "mobile_nos"]:
-          if p in cmd_r and isinstance(cmd_r[p], (list, tuple)):
-            t[p].update(cmd_r[p])
-
-      elif target.type == "FCM Topic":
-        t.fcm_topics.add(target.fcm_topic)
-      elif target.type == "Emails":
-        t.emails.update(target.emails.split(","))
-      elif target.type == "Mobile Nos":
-        t.mobile_nos.update(target.mobile_nos.split(","))
-
-    if self.medium == "FCM":
-      self.send_via_fcm(t)
-    elif self.medium == "SMS":
-      self.send_via_mobile(t)
-    elif self.medium == "Email":
-      self.send_via_email(t)
-
-    self.db_set("status", "Sent")
-    self.reload()
+    values = frappe._dict(status="Queued", last_error=None)
+    if self.status not in ("Failed", "Queued", "Sending"):
+      values.update(checkpoint=None, sent_count=0, failed_count=0)
+      clear_sent_recipients(self.name)
+    self.db_set(values, notify=True)
+    frappe.enqueue("renovation_core.renovation_core.doctype.broadcast_message.broadcast_message.run_broadcast",
+                   queue="long", timeout=BROADCAST_TIMEOUT, enqueue_after_commit=True,
+                   job_name=get_broadcast_job_name(self.name), name=self.name)
     return "ok"
 
-  def get_target_users_from_docs(self, doctype, filters, user_path):
-    docs = frappe.get_list(doctype, filters=filters)
-
-    def resolve_user(doc, path):
-      field = path.pop(0)
-      value = doc.get(field)
-
-      if not value:
-        print(
-            "No value while resolving {} in {}:{}".format(
-                field, doc.doctype, doc.name
-            )
-        )
-        return None
-
-      if not len(path):
-        return value
-
-      df = doc.meta.get_field(field)
-      if df.fieldtype == "Link":
-        return resolve_user(frappe.get_doc(df.options, value), path)
-      elif df.fieldtype == "Dynamic Link":
-        return resolve_user(frappe.get_doc(doc.get(df.options), value), path)
-      else:
-        return value
-
-    users = []
-    for d in docs:
-      u = resolve_user(
-          frappe.get_doc(doctype, d.name),
-          user_path.split(".")[1:]
-      )
-      if u and frappe.db.exists("User", u):
-        users.append(u)
-
-    return users
+  def is_running(self):
+    """
+    A Queued or Sending broadcast is running while its job is queued or started in RQ,
+    and a Sending one only while it keeps saving its progress
+    """
+    if self.status not in ("Queued", "Sending"):
+      return False
+    if self.status == "Sending" and \
+            time_diff_in_seconds(now_datetime(), self.modified) > BROADCAST_HEARTBEAT_TIMEOUT:
+      return False
+    return is_broadcast_job_alive(self.name)
+
+  def run(self):
+    """
+    Streams the targets in pages and dispatches every page,
+    saving the progress and the checkpoint after each one
+    """
+    checkpoint = frappe._dict(frappe.parse_json(self.checkpoint or "{}") or {})
+    self.db_set("status", "Sending", notify=True)
+    frappe.db.commit()
+    try:
+      for idx, target in enumerate(self.targets):
+        if idx < cint(checkpoint.target):
+          continue
+        after = checkpoint.after if idx == cint(checkpoint.target) else None
+        for t, after in self.get_target_pages(target, after):
+          sent, failed = self.dispatch(t)
+          self.save_progress(sent, failed, frappe._dict(target=idx, after=after))
+        self.save_progress(0, 0, frappe._dict(target=idx + 1, after=None))
+    except Exception:
+      frappe.db.rollback()
+      self.db_set({"status": "Failed", "last_error": frappe.get_traceback()}, notify=True)
+      frappe.db.commit()
+      raise
+
+    self.db_set("status", "Sent", notify=True)
+    frappe.db.commit()
+
+  def save_progress(self, sent, failed, checkpoint):
+    self.db_set({
+        "sent_count": cint(self.sent_count) + sent,
+        "failed_count": cint(self.failed_count) + failed,
+        "checkpoint": frappe.as_json(checkpoint)
+    }, notify=True)
+    frappe.db.commit()
+
+  def get_target_pages(self, target, after=None):
+    """
+    Yields (recipients, checkpoint of the page) of the target, starting after the given checkpoint
+    """
+    if target.type == "DocType":
+      while True:
+        users = self.get_target_users_from_docs(
+            target.target_dt, frappe.parse_json(target.filters), target.user_path,
+            after=after, limit=BROADCAST_PAGE_SIZE)
+        if not len(users):
+          break
+        after = users[-1]
+        yield get_recipients(users=users), after
+
+    elif target.type in ("Emails", "Mobile Nos"):
+      fieldname = "emails" if target.type == "Emails" else "mobile_nos"
+      values = [x.strip() for x in (target.get(fieldname) or "").split(",") if x.strip()]
+      for i in range(cint(after), len(values), BROADCAST_PAGE_SIZE):
+        yield get_recipients(**{fieldname: values[i:i + BROADCAST_PAGE_SIZE]}), i + BROADCAST_PAGE_SIZE
+
+    elif after:
+      # CMD and FCM Topic targets are a single page
+      return
+
+    elif target.type == "CMD":
+      cmd_r = frappe.get_attr(target.cmd)()
+      yield get_recipients(**{p: cmd_r[p] for p in RECIPIENT_TYPES
+                              if p in cmd_r and isinstance(cmd_r[p], (list, tuple))}), "done"
+
+    elif target.type == "FCM Topic":
+      yield get_recipients(fcm_topics=[target.fcm_topic]), "done"
+
+  def dispatch(self, t):
+    """
+    Sends to the recipients of the page not sent to by an earlier page
+    A page that fails validation, like one without a single valid mobile no,
+    is counted as failed so that the run moves on instead of failing on it every time
+
+    Returns (sent, failed)
+    """
+    t = filter_sent_recipients(self.name, t)
+    t.title = self.title
+    t.body = self.body
+    try:
+      if self.medium == "FCM":
+        return self.send_via_fcm(t)
+      elif self.medium == "SMS":
+        return self.send_via_mobile(t)
+      elif self.medium == "Email":
+        return self.send_via_email(t)
+    except frappe.ValidationError:
+      frappe.log_error(title="Broadcast Message Page Failed",
+                       message="{}\n{}".format(self.name, frappe.get_traceback()))
+      return 0, sum(len(t[p]) for p in RECIPIENT_TYPES)
+    except Exception:
+      # the page is sent again when the run resumes
+      unmark_sent_recipients(self.name, t)
+      raise
+
+    return 0, 0
+
+  def get_target_users_from_docs(self, doctype, filters, user_path, after=None, limit=None):
+    """
+    The user_path is compiled into a single joined query per Dynamic Link doctype,
+    returning the distinct existing users of the documents matching the filters
+    Users are ordered by name so that they can be paged with after and limit
+    """
+    docs_query = frappe.get_list(doctype, filters=filters, fields=["name"], run=0)
+    queries = []
+    for joins, conditions, column in compile_user_path(
+            doctype, docs_query, user_path.split(".")[1:]):
+      queries.append("""
+        SELECT `user`.name
+        FROM `tab{doctype}` `t0`
+        {joins}
+        INNER JOIN `tabUser` `user` ON `user`.name = {column}
+        WHERE `t0`.name IN (SELECT `docs`.name FROM ({docs_query}) `docs`) {conditions}
+      """.format(doctype=doctype, joins=" ".join(joins), column=column, docs_query=docs_query,
+                 conditions="".join(" AND {}".format(x) for x in conditions)))
+    if not len(queries):
+      return []
+
+    return frappe.db.sql_list("""
+      SELECT `users`.name FROM ({queries}) `users`
+      {after}
+      ORDER BY `users`.name
+      {limit}
+    """.format(queries=" UNION ".join(queries),
+               after="WHERE `users`.name > {}".format(frappe.db.escape(after)) if after else "",
+               limit="LIMIT {}".format(cint(limit)) if limit else ""))
 
   def send_via_fcm(self, t):
-    from renovation_core.utils.fcm import notify_via_fcm
-    notify_via_fcm(
+    from renovation_core.utils.fcm import _notify_via_fcm
+    if not (t.users or t.roles or t.fcm_topics or t.fcm_tokens):
+      return 0, 0
+
+    r = _notify_via_fcm(
         title=t.title,
         body=t.body,
         data=None,
         users=t.users,
+        roles=t.roles,
         topics=t.fcm_topics,
         tokens=t.fcm_tokens
     )
+    return r.success_count, r.failure_count
 
   def send_via_mobile(self, t):
+    from renovation_core.utils.recipients import get_role_users, get_user_mobile_nos
     from renovation_core.utils.sms_setting import send_sms
-    user_mobiles = [
-        x.mobile_no for x in frappe.get_all(
-            "User",
-            filters={"name": ["IN", t.users], "mobile_no": ["is", "set"]},
-            fields=["mobile_no"]
-        ) if x.mobile_no
-    ]
-    t.mobile_nos.update(user_mobiles)
-    send_sms(
+    if len(t.roles):
+      t.users.update(get_role_users(t.roles))
+    t.mobile_nos.update(get_user_mobile_nos(t.users))
+    if not len(t.mobile_nos):
+      return 0, 0
+
+    r = send_sms(
         receiver_list=list(t.mobile_nos),
         msg=t.body,
         sender_name='',
-        success_msg=True,
+        success_msg=False,
         provider=self.get("country_wise_sms_providers", default=[])
-    )
+    ) or []
+    sent = sum(cint(x.no_of_sent_sms) if hasattr(x, "no_of_sent_sms") else 1 for x in r)
+    return sent, max(len(t.mobile_nos) - sent, 0)
 
   def send_via_email(self, t):
-    frappe.throw("Not yet implemented")
+    """
+    The title and body are rendered once per language of the recipients,
+    explicit emails get the language of the System Settings
+    """
+    from renovation_core.utils.bulk_email import enqueue_bulk_email
+    from renovation_core.utils.recipients import get_role_users, get_user_contacts
+    if len(t.roles):
+      t.users.update(get_role_users(t.roles))
+
+    default_lang = frappe.db.get_single_value("System Settings", "language") or "en"
+    lang_emails = frappe._dict({default_lang: set(t.emails)})
+    for u in get_user_contacts(t.users).values():
+      if cint(u.enabled) and u.email:
+        lang_emails.setdefault(u.language or default_lang, set()).add(u.email)
+
+    requested = sum(len(x) for x in lang_emails.values())
+    if not requested:
+      return 0, 0
+
+    queued = 0
+    lang = frappe.local.lang
+    try:
+      for _lang, emails in lang_emails.items():
+        if not len(emails):
+          continue
+        frappe.local.lang = _lang
+        context = {"doc": self}
+        queued += len(enqueue_bulk_email(
+            list(emails),
+            subject=frappe.render_template(t.title, context),
+            message=frappe.render_template(t.body, context),
+            reference_doctype=self.doctype,
+            reference_name=self.name
+        ))
+    finally:
+      frappe.local.lang = lang
+
+    return queued, requested - queued
+
+
+def run_broadcast(name):
+  frappe.get_doc("Broadcast Message", name).run()
+
+
+def get_broadcast_job_name(name):
+  return "broadcast_message|{}".format(name)
+
+
+def is_broadcast_job_alive(name):
+  """
+  Checks the queued and started jobs of the long queue for the run of the broadcast
+  """
+  from frappe.utils.background_jobs import get_queue
+  from rq.job import Job
+  from rq.registry import StartedJobRegistry
+
+  q = get_queue("long")
+  job_ids = q.job_ids + StartedJobRegistry(queue=q).get_job_ids()
+  job_name = get_broadcast_job_name(name)
+  for job in Job.fetch_many(job_ids, connection=q.connection):
+    if job and job.kwargs.get("site") == frappe.local.site and job.kwargs.get("job_name") == job_name:
+      return True
+  return False
+
+
+def get_recipients(**kwargs):
+  return frappe._dict({p: set(kwargs.get(p) or []) for p in RECIPIENT_TYPES})
+
+
+def filter_sent_recipients(name, t):
+  """
+  Drops the recipients already sent to by this broadcast and marks the rest as sent
+  """
+  key = _get_sent_recipients_key(name)
+  pipe = frappe.cache().pipeline()
+  recipients = [(p, x) for p in RECIPIENT_TYPES for x in t[p]]
+  for p, x in recipients:
+    pipe.sadd(key, "{}:{}".format(p, x))
+  pipe.expire(key, BROADCAST_RECIPIENTS_EXPIRY)
+  added = pipe.execute()
+
+  _t = get_recipients()
+  for (p, x), is_new in zip(recipients, added):
+    if is_new:
+      _t[p].add(x)
+  return _t
+
+
+def unmark_sent_recipients(name, t):
+  recipients = ["{}:{}".format(p, x) for p in RECIPIENT_TYPES for x in t[p]]
+  if len(recipients):
+    pipe = frappe.cache().pipeline()
+    pipe.srem(_get_sent_recipients_key(name), *recipients)
+    pipe.execute()
+
+
+def clear_sent_recipients(name):
+  pipe = frappe.cache().pipeline()
+  pipe.delete(_get_sent_recipients_key(name))
+  pipe.execute()
+
+
+def _get_sent_recipients_key(name):
+  return frappe.cache().make_key("{}|{}".format(BROADCAST_RECIPIENTS_KEY, name))
+
+
+def compile_user_path(root_doctype, docs_query, path, doctype=None, joins=None, conditions=None,
+                      skip_missing=False):
+  """
+  Follows the fields of the path through the doctype metas,
+  joining the linked doctype of every Link on the way
+  Standard fields like owner and modified_by are plain columns
+
+  A Dynamic Link branches into one query per linked doctype found in the documents,
+  leaving out the linked doctypes that do not have the rest of the path
+
+  Returns [(joins, conditions, user column)]
+  """
+  doctype = doctype or root_doctype
+  joins = joins or []
+  conditions = conditions or []
+  alias = "t{}".format(len(joins))
+  field = path[0]
+  df = frappe.get_meta(doctype).get_field(field)
+  if not df and field not in default_fields:
+    if skip_missing:
+      return []
+    frappe.throw("Invalid User Path: {} not found in {}".format(field, doctype))
+
+  column = "`{}`.`{}`".format(alias, field)
+  if len(path) == 1 or not df or df.fieldtype not in ("Link", "Dynamic Link"):
+    return [(joins, conditions, column)]
+
+  if df.fieldtype == "Link":
+    link_doctypes = [df.options]
+  else:
+    link_doctypes = frappe.db.sql_list("""
+      SELECT DISTINCT `{alias}`.`{options}`
+      FROM `tab{doctype}` `t0`
+      {joins}
+      WHERE `t0`.name IN (SELECT `docs`.name FROM ({docs_query}) `docs`) AND IFNULL(`{alias}`.`{options}`, '') != '' {conditions}
+    """.format(alias=alias, options=df.options, doctype=root_doctype,
+               joins=" ".join(joins), docs_query=docs_query,
+               conditions="".join(" AND {}".format(x) for x in conditions)))
+
+  queries = []
+  next_alias = "t{}".format(len(joins) + 1)
+  for link_doctype in link_doctypes:
+    _conditions = list(conditions)
+    if df.fieldtype == "Dynamic Link":
+      _conditions.append("`{}`.`{}` = {}".format(
+          alias, df.options, frappe.db.escape(link_doctype)))
+    queries.extend(compile_user_path(
+        root_doctype, docs_query, path[1:], doctype=link_doctype,
+        joins=joins + ["INNER JOIN `tab{}` `{}` ON `{}`.name = {}".format(
+            link_doctype, next_alias, next_alias, column)],
+        conditions=_conditions, skip_missing=skip_missing or df.fieldtype == "Dynamic Link"))
+
+  return queries
@@ -20,7 +20,38 @@ class TestBroadcastMessage(RenovationTestCase):
             }
         ]
     })
-    self.assertIs(n.send(), 'ok')
+    # only submitted broadcasts can be sent
+    self.assertRaises(frappe.ValidationError, n.send)
+
+  def test_get_target_users_from_docs(self):
+    assignee = self.make_todo(assigned_by="Administrator")
+    note = self.make_doc({"doctype": "Note", "title": self.faker.sentence()})
+    todos = [
+        self.make_todo(reference_type="ToDo", reference_name=assignee),
+        self.make_todo(reference_type="Note", reference_name=note)
+    ]
+    n = frappe.new_doc("Broadcast Message")
+
+    def get_users(user_path, names):
+      return n.get_target_users_from_docs("ToDo", {"name": ["in", names]}, user_path)
+
+    # Link
+    self.assertEqual(get_users("ToDo.assigned_by.name", [assignee]), ["Administrator"])
+    # Standard field
+    self.assertEqual(get_users("ToDo.owner", [assignee]), [frappe.session.user])
+    # Dynamic Link, Note does not have assigned_by
+    self.assertEqual(get_users("ToDo.reference_name.assigned_by", todos), ["Administrator"])
+    self.assertEqual(get_users("ToDo.reference_name.modified_by", todos), [frappe.session.user])
+
+    self.assertRaises(frappe.ValidationError, get_users, "ToDo.no_such_field", todos)
+
+  def make_todo(self, **kwargs):
+    return self.make_doc(dict(doctype="ToDo", description=self.faker.sentence(), **kwargs))
+
+  def make_doc(self, d):
+    doc = frappe.get_doc(d).insert(ignore_permissions=True)
+    self.addCleanup(frappe.delete_doc, doc.doctype, doc.name, ignore_permissions=True, force=True)
+    return doc.name
 
   def get_test_records(self):
     return generate_doc('Broadcast Message')
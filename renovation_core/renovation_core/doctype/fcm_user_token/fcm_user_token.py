@@ -5,6 +5,14 @@
 from __future__ import unicode_literals
 # import frappe
 from frappe.model.document import Document
+from renovation_core.utils.device_tokens import index_token, unindex_tokens
+from renovation_core.utils.fcm_topics import on_token_change
 
 class FCMUserToken(Document):
-	pass
+	def after_insert(self):
+		index_token(self.doctype, self.user, self.token, self.linked_sid)
+		on_token_change([self.token])
+
+	def on_trash(self):
+		unindex_tokens(self.doctype, [(self.user, self.token)])
+		on_token_change([self.token])
@@ -5,6 +5,11 @@
 from __future__ import unicode_literals
 # import frappe
 from frappe.model.document import Document
+from renovation_core.utils.device_tokens import index_token, unindex_tokens
 
 class HuaweiUserToken(Document):
-	pass
+	def after_insert(self):
+		index_token(self.doctype, self.user, self.token, self.linked_sid)
+
+	def on_trash(self):
+		unindex_tokens(self.doctype, [(self.user, self.token)])
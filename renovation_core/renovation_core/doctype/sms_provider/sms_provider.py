@@ -5,11 +5,16 @@
 from __future__ import unicode_literals
 import frappe
 from frappe.model.document import Document
+from renovation_core.utils.sms_setting import clear_sms_routing_table
 
 
 class SMSProvider(Document):
   def on_update(self):
     self.check_and_update_system_setting()
+    clear_sms_routing_table()
+
+  def on_trash(self):
+    clear_sms_routing_table()
 
   def check_and_update_system_setting(self):
     if not frappe.db.get_default("sms_settings"):
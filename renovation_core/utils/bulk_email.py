@@ -0,0 +1,87 @@
+import frappe
+from frappe.model.naming import make_autoname
+from frappe.utils import cstr, html2text, now, validate_email_address
+
+from .device_tokens import QUERY_CHUNK_SIZE, get_chunks
+
+"""
+Bulk Email
+Queues one rendered email for many recipients with multi-row inserts into Email Queue and Email Queue Recipient,
+skipping the Document hooks. Every Email Queue covers up to EMAIL_QUEUE_BATCH_SIZE recipients.
+
+The To header and the unsubscribe url are placeholders that frappe fills in per recipient while sending
+"""
+
+# Recipients of a single Email Queue
+EMAIL_QUEUE_BATCH_SIZE = 500
+# Bulk emails are sent after the others
+EMAIL_QUEUE_PRIORITY = 0
+UNSUBSCRIBE_METHOD = "/api/method/frappe.email.queue.unsubscribe"
+
+
+def enqueue_bulk_email(recipients, subject, message, reference_doctype, reference_name,
+                       unsubscribe_message=None):
+  """
+  Recipients unsubscribed globally or from any document of the reference_doctype are skipped
+
+  Returns the recipients queued
+  """
+  from frappe.email.email_body import get_email, get_formatted_html
+  from frappe.email.queue import get_unsubscribe_message
+  from frappe.email.smtp import get_outgoing_email_account
+
+  recipients = [x for x in set(validate_email_address(cstr(x)) for x in recipients or []) if x]
+  unsubscribed = get_unsubscribed_emails(recipients, reference_doctype)
+  recipients = [x for x in recipients if x not in unsubscribed]
+  if not len(recipients):
+    return []
+
+  email_account = get_outgoing_email_account(raise_exception_not_set=False)
+  sender = email_account.default_sender if email_account else frappe.session.user
+  unsubscribe_link = get_unsubscribe_message(unsubscribe_message, None)
+  formatted = get_formatted_html(subject, message, email_account=email_account,
+                                 unsubscribe_link=unsubscribe_link)
+  text_content = "{}\n{}".format(html2text(message), unsubscribe_link.text)
+
+  ts = now()
+  user = frappe.session.user
+  queues = []
+  queue_recipients = []
+  for batch in get_chunks(sorted(recipients), EMAIL_QUEUE_BATCH_SIZE):
+    mail = get_email(batch, sender=sender, subject=subject, formatted=formatted,
+                     text_content=text_content, email_account=email_account)
+    name = make_autoname("hash", "Email Queue")
+    queues.append((
+        name, ts, ts, user, user, 0,
+        sender, mail.as_string(), "Not Sent", EMAIL_QUEUE_PRIORITY,
+        reference_doctype, reference_name, mail.msg_root["Message-Id"].strip(" <>"),
+        1, UNSUBSCRIBE_METHOD, email_account.name if email_account else None
+    ))
+    for idx, recipient in enumerate(batch, 1):
+      queue_recipients.append((
+          make_autoname("hash", "Email Queue Recipient"), ts, ts, user, user, 0,
+          name, "Email Queue", "recipients", idx, recipient, "Not Sent"
+      ))
+
+  frappe.db.bulk_insert("Email Queue", fields=[
+      "name", "creation", "modified", "owner", "modified_by", "docstatus",
+      "sender", "message", "status", "priority",
+      "reference_doctype", "reference_name", "message_id",
+      "add_unsubscribe_link", "unsubscribe_method", "email_account"
+  ], values=queues)
+  frappe.db.bulk_insert("Email Queue Recipient", fields=[
+      "name", "creation", "modified", "owner", "modified_by", "docstatus",
+      "parent", "parenttype", "parentfield", "idx", "recipient", "status"
+  ], values=queue_recipients)
+
+  return recipients
+
+
+def get_unsubscribed_emails(emails, reference_doctype):
+  unsubscribed = set()
+  for _emails in get_chunks(emails, QUERY_CHUNK_SIZE):
+    unsubscribed.update(frappe.db.sql_list("""
+      SELECT DISTINCT email FROM `tabEmail Unsubscribe`
+      WHERE email IN %(emails)s AND (global_unsubscribe = 1 OR reference_doctype = %(reference_doctype)s)
+    """, {"emails": tuple(_emails), "reference_doctype": reference_doctype}))
+  return unsubscribed
@@ -0,0 +1,513 @@
+import json
+
+import frappe
+from frappe.utils import cint, get_datetime, now, now_datetime, \
+  time_diff_in_seconds
+
+"""
+Device Tokens
+- FCM User Token
+- Huawei User Token
+
+Both the doctypes share the same structure { token, user, linked_sid, last_updated }
+A token linked to a sid is valid only as long as the linked session is valid
+
+Token Index
+The tokens are indexed in redis per user so that sends can skip the database
+  device_token_index|{doctype}|{user}: { token: { sid, expires_at }, __indexed__: 1 }
+  device_token_index_built|{doctype}: set once the index is built from the database
+The index is kept up to date by the token doctype controllers and logout
+Until the index is built, tokens are resolved from the database
+
+The cache evicts keys, so a user is read from the index only when the __indexed__ sentinel is there,
+other users are indexed again from the database on their next send
+Tokens removed from the index are remembered for a while, so that an indexing that read them
+from the database before they were deleted does not write them back
+  device_token_unindexed|{doctype}: set of [user, token]
+
+Heartbeats
+register_client on a known token only buffers its last_updated in redis
+  device_token_heartbeat|{doctype}: { name: last_updated }
+which is written in bulk by the scheduler
+"""
+
+TOKEN_DOCTYPES = ("FCM User Token", "Huawei User Token")
+TOKEN_INDEX_KEY = "device_token_index"
+TOKEN_INDEX_SENTINEL = "__indexed__"
+TOKEN_UNINDEXED_KEY = "device_token_unindexed"
+# Seconds the removed tokens are remembered for, longer than an indexing takes
+TOKEN_UNINDEXED_EXPIRY = 60 * 60
+TOKEN_HEARTBEAT_KEY = "device_token_heartbeat"
+# Tokens updated within this many seconds are not updated again,
+# override with device_token_heartbeat_interval in site_config
+TOKEN_HEARTBEAT_INTERVAL = 60 * 60
+
+# Max number of values passed into a single IN clause
+QUERY_CHUNK_SIZE = 1000
+
+
+def get_chunks(items, size):
+  """
+  Splits a list into lists of at most `size` items
+  """
+  items = list(items or [])
+  return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def resolve_tokens(doctype="FCM User Token", users=None, roles=None):
+  """
+  Resolves the device tokens of the users from the token index when it is built,
+  falling back to the database otherwise
+
+  Returns frappe._dict like get_valid_tokens, on both paths
+
+  Stale tokens are left for delete_expired_tokens to clean up
+  """
+  if not is_token_index_built(doctype):
+    return get_valid_tokens(doctype, users=users, roles=roles)
+
+  from .recipients import get_role_users
+
+  users = set(users or [])
+  if roles:
+    users.update(get_role_users(roles))
+
+  return get_indexed_tokens(doctype, users)
+
+
+def get_valid_tokens(doctype="FCM User Token", users=None, roles=None):
+  """
+  Resolves the device tokens of many users at once.
+  Validity of the linked sessions is checked in the same query by joining against `tabSessions`
+
+  :param doctype: FCM User Token / Huawei User Token
+  :param users: list of users
+  :param roles: list of roles, whose users are included as well, resolved from the recipients cache
+
+  Returns frappe._dict
+    - tokens: list of valid tokens
+    - user_tokens: { user: [tokens] }
+    - stale_tokens: tokens whose linked session is no longer valid
+  """
+  if doctype not in TOKEN_DOCTYPES:
+    frappe.throw("Invalid Token DocType")
+
+  from .recipients import get_role_users
+
+  users = set(users or [])
+  if roles:
+    users.update(get_role_users(roles))
+
+  rows = []
+  for _users in get_chunks(users, QUERY_CHUNK_SIZE):
+    rows.extend(_get_token_rows(
+        doctype, "WHERE t.user IN %(users)s", {"users": tuple(_users)}))
+
+  r = frappe._dict(tokens=[], user_tokens=frappe._dict(), stale_tokens=[])
+  visited = set()
+  for row in rows:
+    if row.name in visited:
+      continue
+    visited.add(row.name)
+
+    if not row.token:
+      continue
+    if not cint(row.is_valid):
+      r.stale_tokens.append(row.token)
+      continue
+
+    r.tokens.append(row.token)
+    r.user_tokens.setdefault(row.user, []).append(row.token)
+
+  return r
+
+
+def _get_token_rows(doctype, condition, values):
+  """
+  Mirrors fcm.is_valid_session_id for every token in a single query
+  Tokens without a linked sid are always valid
+  """
+  from frappe.sessions import get_expiry_period_for_query
+  values.update({
+      "desktop_expiry": get_expiry_period_for_query("desktop"),
+      "mobile_expiry": get_expiry_period_for_query("mobile")
+  })
+
+  return frappe.db.sql("""
+    SELECT DISTINCT
+      t.name, t.user, t.token,
+      CASE
+        WHEN IFNULL(t.linked_sid, '') = '' THEN 1
+        WHEN s.sid IS NULL THEN 0
+        WHEN s.device = 'mobile' THEN (NOW() - s.lastupdate) < %(mobile_expiry)s
+        ELSE (NOW() - s.lastupdate) < %(desktop_expiry)s
+      END AS is_valid
+    FROM `tab{doctype}` t
+    LEFT JOIN `tabSessions` s ON s.sid = t.linked_sid
+    {condition}
+  """.format(doctype=doctype, condition=condition), values, as_dict=1)
+
+
+def delete_tokens(doctype, names=None, tokens=None):
+  """
+  Deletes tokens in bulk, either by their docnames or by the token values
+  The deleted tokens are removed from the token index as well
+  Returns the number of deleted tokens
+  """
+  if doctype not in TOKEN_DOCTYPES:
+    frappe.throw("Invalid Token DocType")
+
+  count = 0
+  deleted_tokens = []
+  for fieldname, values in (("name", names), ("token", tokens)):
+    for _values in get_chunks(set(values or []), QUERY_CHUNK_SIZE):
+      rows = frappe.db.sql("""
+        SELECT name, user, token FROM `tab{doctype}` WHERE `{fieldname}` IN %(values)s
+      """.format(doctype=doctype, fieldname=fieldname), {"values": tuple(_values)}, as_dict=1)
+      if not len(rows):
+        continue
+
+      frappe.db.sql("""
+        DELETE FROM `tab{doctype}` WHERE name IN %(names)s
+      """.format(doctype=doctype), {"names": tuple(x.name for x in rows)})
+      unindex_tokens(doctype, [(x.user, x.token) for x in rows])
+      deleted_tokens.extend(x.token for x in rows)
+      count += len(rows)
+
+  if doctype == "FCM User Token" and len(deleted_tokens):
+    from .fcm_topics import on_token_change
+    on_token_change(deleted_tokens)
+
+  return count
+
+
+def delete_expired_tokens():
+  """
+  Deletes the tokens whose linked session no longer exists or has expired
+  in chunks of QUERY_CHUNK_SIZE
+
+  This function is called attached to the scheduler to be invoked every hour
+  """
+  from frappe.sessions import get_expiry_period_for_query
+
+  values = {
+      "desktop_expiry": get_expiry_period_for_query("desktop"),
+      "mobile_expiry": get_expiry_period_for_query("mobile"),
+      "limit": QUERY_CHUNK_SIZE
+  }
+  counts = frappe._dict()
+  for doctype in TOKEN_DOCTYPES:
+    counts[doctype] = 0
+    while True:
+      names = [x[0] for x in frappe.db.sql("""
+        SELECT t.name
+        FROM `tab{doctype}` t
+        LEFT JOIN `tabSessions` s ON s.sid = t.linked_sid
+        WHERE IFNULL(t.linked_sid, '') != '' AND (
+          s.sid IS NULL OR
+          (s.device = 'mobile' AND (NOW() - s.lastupdate) >= %(mobile_expiry)s) OR
+          (IFNULL(s.device, '') != 'mobile' AND (NOW() - s.lastupdate) >= %(desktop_expiry)s)
+        )
+        LIMIT %(limit)s
+      """.format(doctype=doctype), values)]
+      if not len(names):
+        break
+
+      counts[doctype] += delete_tokens(doctype, names=names)
+      frappe.db.commit()
+
+  print("Deleted expired tokens: {}".format(
+      ", ".join("{} {}".format(v, k) for k, v in counts.items())))
+  return counts
+
+
+def is_token_index_built(doctype):
+  pipe = frappe.cache().pipeline()
+  pipe.exists(_get_index_built_key(doctype))
+  return bool(pipe.execute()[0])
+
+
+def get_indexed_tokens(doctype, users):
+  """
+  Reads the tokens of all the users in a single pipelined redis read
+  Users missing from the index are indexed from the database
+  Entries whose linked session has passed its expiry are re-checked against tabSessions,
+  since the session could have been extended after the token was indexed
+  """
+  users = list(set(users or []))
+  r = frappe._dict(tokens=[], user_tokens=frappe._dict(), stale_tokens=[])
+  if not len(users):
+    return r
+
+  pipe = frappe.cache().pipeline()
+  for user in users:
+    pipe.hgetall(_get_index_key(doctype, user))
+
+  user_entries = frappe._dict()
+  missing = []
+  for user, entries in zip(users, pipe.execute()):
+    entries = {frappe.safe_decode(k): v for k, v in (entries or {}).items()}
+    if TOKEN_INDEX_SENTINEL not in entries:
+      missing.append(user)
+      continue
+    del entries[TOKEN_INDEX_SENTINEL]
+    user_entries[user] = {k: json.loads(frappe.safe_decode(v)) for k, v in entries.items()}
+
+  if len(missing):
+    user_entries.update(index_users(doctype, missing))
+
+  ts = now_datetime().timestamp()
+  expired = []
+  for user, entries in user_entries.items():
+    for token, entry in entries.items():
+      if entry.get("sid") and (entry.get("expires_at") or 0) <= ts:
+        expired.append((user, token, entry.get("sid")))
+        continue
+
+      r.tokens.append(token)
+      r.user_tokens.setdefault(user, []).append(token)
+
+  if len(expired):
+    session_expiry = _get_session_expiry(set(x[2] for x in expired))
+    pipe = frappe.cache().pipeline()
+    for user, token, sid in expired:
+      expires_at = session_expiry.get(sid)
+      if expires_at and expires_at > ts:
+        pipe.hset(_get_index_key(doctype, user), token,
+                  json.dumps({"sid": sid, "expires_at": expires_at}))
+        r.tokens.append(token)
+        r.user_tokens.setdefault(user, []).append(token)
+      else:
+        # Removed from the database by delete_expired_tokens
+        pipe.hdel(_get_index_key(doctype, user), token)
+        r.stale_tokens.append(token)
+    pipe.execute()
+
+  return r
+
+
+def index_token(doctype, user, token, linked_sid=None):
+  """
+  Users not in the index are left to be indexed on their next send
+  """
+  expires_at = None
+  if linked_sid:
+    expires_at = _get_session_expiry([linked_sid]).get(linked_sid, 0)
+
+  pipe = frappe.cache().pipeline()
+  pipe.srem(_get_unindexed_key(doctype), json.dumps([user, token]))
+  pipe.hset(_get_index_key(doctype, user), token,
+            json.dumps({"sid": linked_sid or None, "expires_at": expires_at}))
+  pipe.execute()
+
+
+def unindex_tokens(doctype, user_tokens):
+  """
+  :param user_tokens: list of (user, token)
+  """
+  user_tokens = list(user_tokens or [])
+  if not len(user_tokens):
+    return
+
+  pipe = frappe.cache().pipeline()
+  for user, token in user_tokens:
+    pipe.hdel(_get_index_key(doctype, user), token)
+  pipe.sadd(_get_unindexed_key(doctype), *[json.dumps([user, token]) for user, token in user_tokens])
+  pipe.expire(_get_unindexed_key(doctype), TOKEN_UNINDEXED_EXPIRY)
+  pipe.execute()
+
+
+def unindex_session(user, sid):
+  """
+  Removes the tokens linked to the sid from the index, called on logout
+  """
+  if not user or not sid:
+    return
+
+  for doctype in TOKEN_DOCTYPES:
+    pipe = frappe.cache().pipeline()
+    pipe.hgetall(_get_index_key(doctype, user))
+    entries = {frappe.safe_decode(k): v for k, v in (pipe.execute()[0] or {}).items()}
+    entries.pop(TOKEN_INDEX_SENTINEL, None)
+
+    unindex_tokens(doctype, [(user, token) for token, entry in entries.items()
+                             if json.loads(frappe.safe_decode(entry)).get("sid") == sid])
+
+
+def index_users(doctype, users):
+  """
+  Indexes all the tokens of the users from the database, marking them as indexed
+  Returns { user: { token: { sid, expires_at } } }
+  """
+  rows = []
+  for _users in get_chunks(set(users or []), QUERY_CHUNK_SIZE):
+    rows.extend(_get_index_rows(doctype, "WHERE t.user IN %(users)s", {"users": tuple(_users)}))
+
+  user_entries = frappe._dict({x: {} for x in users or []})
+  _add_index_entries(user_entries, rows)
+  _write_index_entries(doctype, user_entries)
+  return user_entries
+
+
+def rebuild_token_index(doctype=None):
+  """
+  Rebuilds the token index from the database
+  Returns the number of indexed tokens
+  """
+  count = 0
+  for dt in ([doctype] if doctype else TOKEN_DOCTYPES):
+    # Sends fall back to the database while the index is being rebuilt
+    pipe = frappe.cache().pipeline()
+    pipe.delete(_get_index_built_key(dt))
+    pipe.delete(_get_unindexed_key(dt))
+    pipe.execute()
+    frappe.cache().delete_keys("{}|{}|".format(TOKEN_INDEX_KEY, dt))
+
+    rows = _get_index_rows(dt)
+    user_entries = frappe._dict()
+    _add_index_entries(user_entries, rows)
+    _write_index_entries(dt, user_entries)
+
+    pipe = frappe.cache().pipeline()
+    pipe.set(_get_index_built_key(dt), 1)
+    pipe.execute()
+    count += len(rows)
+
+  return count
+
+
+def _get_index_rows(doctype, condition="", values=None):
+  return frappe.db.sql("""
+    SELECT t.user, t.token, t.linked_sid, s.sid, s.device, s.lastupdate
+    FROM `tab{doctype}` t
+    LEFT JOIN `tabSessions` s ON s.sid = t.linked_sid
+    {condition}
+  """.format(doctype=doctype, condition=condition), values or {}, as_dict=1)
+
+
+def _add_index_entries(user_entries, rows):
+  expiry = _get_expiry_in_seconds()
+  for row in rows:
+    if not row.user or not row.token:
+      continue
+    expires_at = None
+    if row.linked_sid:
+      expires_at = _get_expires_at(expiry, row.device, row.lastupdate) if row.sid else 0
+    user_entries.setdefault(row.user, {})[row.token] = {"sid": row.linked_sid, "expires_at": expires_at}
+
+
+def _write_index_entries(doctype, user_entries):
+  """
+  Writes the entries with the sentinel of every user,
+  then drops the tokens that were removed from the index meanwhile
+  """
+  for _users in get_chunks(user_entries.keys(), QUERY_CHUNK_SIZE):
+    pipe = frappe.cache().pipeline()
+    for user in _users:
+      key = _get_index_key(doctype, user)
+      pipe.hset(key, TOKEN_INDEX_SENTINEL, 1)
+      for token, entry in user_entries[user].items():
+        pipe.hset(key, token, json.dumps(entry))
+    pipe.execute()
+
+  pipe = frappe.cache().pipeline()
+  pipe.smembers(_get_unindexed_key(doctype))
+  unindexed = [json.loads(frappe.safe_decode(x)) for x in pipe.execute()[0] or []]
+  unindexed = [(user, token) for user, token in unindexed if token in user_entries.get(user, {})]
+  if not len(unindexed):
+    return
+
+  for user, token in unindexed:
+    pipe.hdel(_get_index_key(doctype, user), token)
+    del user_entries[user][token]
+  pipe.execute()
+
+
+def _get_session_expiry(sids):
+  """
+  Returns { sid: expires_at } for the sids that still exist in tabSessions
+  """
+  expiry = _get_expiry_in_seconds()
+  session_expiry = frappe._dict()
+  for _sids in get_chunks(set(sids), QUERY_CHUNK_SIZE):
+    for s in frappe.db.sql("""
+      SELECT sid, device, lastupdate FROM `tabSessions` WHERE sid IN %(sids)s
+    """, {"sids": tuple(_sids)}, as_dict=1):
+      session_expiry[s.sid] = _get_expires_at(expiry, s.device, s.lastupdate)
+
+  return session_expiry
+
+
+def _get_expiry_in_seconds():
+  from frappe.sessions import get_expiry_in_seconds
+  return frappe._dict({
+      "desktop": get_expiry_in_seconds(device="desktop"),
+      "mobile": get_expiry_in_seconds(device="mobile")
+  })
+
+
+def touch_token(doctype, name, last_updated=None):
+  """
+  Buffers the last_updated of a token in redis instead of writing it right away
+  Skipped altogether if the token was updated recently enough
+  """
+  interval = cint(frappe.conf.get("device_token_heartbeat_interval")
+                  ) or TOKEN_HEARTBEAT_INTERVAL
+  if last_updated and time_diff_in_seconds(now_datetime(), last_updated) < interval:
+    return
+
+  pipe = frappe.cache().pipeline()
+  pipe.hset(_get_heartbeat_key(doctype), name, now())
+  pipe.execute()
+
+
+def flush_token_heartbeats():
+  """
+  Writes the buffered heartbeats with a bulk UPDATE per chunk
+  This function is called attached to the scheduler
+  """
+  count = 0
+  for doctype in TOKEN_DOCTYPES:
+    key = _get_heartbeat_key(doctype)
+    pipe = frappe.cache().pipeline()
+    pipe.hgetall(key)
+    pipe.delete(key)
+    heartbeats = [(frappe.safe_decode(name), frappe.safe_decode(ts))
+                  for name, ts in (pipe.execute()[0] or {}).items()]
+
+    for _heartbeats in get_chunks(heartbeats, QUERY_CHUNK_SIZE):
+      values = frappe._dict(names=tuple(x[0] for x in _heartbeats))
+      cases = []
+      for i, (name, ts) in enumerate(_heartbeats):
+        cases.append("WHEN %(name_{0})s THEN %(ts_{0})s".format(i))
+        values["name_{}".format(i)] = name
+        values["ts_{}".format(i)] = ts
+
+      frappe.db.sql("""
+        UPDATE `tab{doctype}`
+        SET last_updated = CASE name {cases} END
+        WHERE name IN %(names)s
+      """.format(doctype=doctype, cases=" ".join(cases)), values)
+      count += len(_heartbeats)
+
+  return count
+
+
+def _get_heartbeat_key(doctype):
+  return frappe.cache().make_key("{}|{}".format(TOKEN_HEARTBEAT_KEY, doctype))
+
+
+def _get_expires_at(expiry, device, lastupdate):
+  return get_datetime(lastupdate).timestamp() + (expiry.get(device) or expiry.desktop)
+
+
+def _get_index_key(doctype, user):
+  return frappe.cache().make_key("{}|{}|{}".format(TOKEN_INDEX_KEY, doctype, user))
+
+
+def _get_unindexed_key(doctype):
+  return frappe.cache().make_key("{}|{}".format(TOKEN_UNINDEXED_KEY, doctype))
+
+
+def _get_index_built_key(doctype):
+  return frappe.cache().make_key("{}_built|{}".format(TOKEN_INDEX_KEY, doctype))
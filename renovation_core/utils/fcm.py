@@ -8,29 +8,94 @@ from frappe.model.naming import make_autoname
 from frappe.utils import cint, now
 from six import string_types
 
+from .device_tokens import TOKEN_DOCTYPES, delete_tokens, get_chunks, \
+    resolve_tokens, touch_token, unindex_session
+from .fcm_topics import FCM_MAX_CONDITION_TOPICS, get_role_topic, get_topic_condition, \
+    split_topic_roles
+from .recipients import get_role_users
+
 """
 Targets
 - All (including Guests)
-- Roles
+- Roles (a single topic send for the roles mirrored as topics, see fcm_topics)
 - User
 
 Each FCM will call register_client on start, which will be stored in frappe.defaults
 There is no expiry date for the tokens now
 """
 
-firebase_app = None
+# firebase_admin apps of the sites served by this process
+#   { site: { fingerprint, app } }
+_firebase_apps = {}
+# Fingerprints of the credentials of the sites, so that they are not read and hashed on every send
+#   { site: (credentials key, fingerprint) }
+_credentials_fingerprints = {}
+
+# send_all of firebase-admin 2.17 accepts at most 100 messages in a single batch request
+FCM_BATCH_SIZE = 100
+# Default number of batches sent in parallel, override with fcm_max_workers in site_config
+FCM_MAX_WORKERS = 8
+# Error codes of tokens that are no longer valid
+FCM_INVALID_TOKEN_CODES = ("registration-token-not-registered",)
+# Number of notification Communications written in a single insert
+COMMUNICATION_BATCH_SIZE = 1000
+
+# Notification counts of a user in redis
+#   fcm_notification_counter|{user}: { total, unseen }
+NOTIFICATION_COUNTER_KEY = "fcm_notification_counter"
+# Counters are recounted from the database at least once a day
+NOTIFICATION_COUNTER_EXPIRY = 24 * 60 * 60
+# Max notifications updated in a single UPDATE
+NOTIFICATION_UPDATE_CHUNK_SIZE = 10000
+_NOTIFICATION_COUNTER_INCR = """
+if redis.call('exists', KEYS[1]) == 1 then
+  redis.call('hincrby', KEYS[1], 'total', ARGV[1])
+  redis.call('hincrby', KEYS[1], 'unseen', ARGV[2])
+end
+"""
 
 
 def get_firebase_certificate():
+  return credentials.Certificate(get_firebase_credentials())
+
+
+def get_firebase_credentials():
   import os
-  cred = frappe.get_site_config().get("firebase_service_account", None)
+  cred = frappe.conf.get("firebase_service_account", None)
   if not cred and os.path.isfile("firebase-adminsdk-cred.json"):
     cred = "firebase-adminsdk-cred.json"
 
   if not cred:
     frappe.throw("Please define firebase_service_account in site_config")
 
-  return credentials.Certificate(cred)
+  return cred
+
+
+def get_credentials_fingerprint(cred):
+  """
+  Cached per site, keyed on the credentials, or the path and the mtime of the credentials file
+  """
+  import hashlib
+  import os
+  if isinstance(cred, dict):
+    key = json.dumps(cred, sort_keys=True)
+  else:
+    key = "{}|{}".format(cred, os.path.getmtime(cred))
+
+  site = frappe.local.site
+  cached = _credentials_fingerprints.get(site)
+  if cached and cached[0] == key:
+    return cached[1]
+
+  if isinstance(cred, dict):
+    content = key
+  else:
+    with open(cred, "r") as f:
+      content = f.read()
+
+  fingerprint = hashlib.sha256(frappe.safe_encode(content)).hexdigest()
+  _credentials_fingerprints[site] = (key, fingerprint)
+  return fingerprint
 
 
 @frappe.whitelist(allow_guest=True)
@@ -79,14 +144,7 @@ def get_client_tokens(user=None):
   if not user:
     user = frappe.session.user if frappe.session else "Guest"
 
-  tokens = []
-  for t in frappe.get_all("FCM User Token", fields=["name", "token", "linked_sid"], filters={"user": user}):
-    if t.linked_sid and not is_valid_session_id(t.linked_sid):
-      frappe.delete_doc("FCM User Token", t.name, ignore_permissions=True)
-      continue
-    tokens.append(t.token)
-
-  return tokens
+  return get_tokens_for("Users", users=[user])
 
 def _add_user_token(user, token, linked_sid=None, is_huawei_token=False):
   dt = "FCM User Token"
@@ -95,14 +153,15 @@ def _add_user_token(user, token, linked_sid=None, is_huawei_token=False):
   _existing = frappe.db.get_value(
     dt,
     {"token": token},
-    ["name", "user"],
+    ["name", "user", "last_updated"],
     as_dict=1
   )
   if _existing:
     if _existing.user != user:
       frappe.delete_doc(dt, _existing.name, force=1, ignore_permissions=True)
     else:
-      frappe.db.set_value(dt, _existing.name, "last_updated", now())
+      # Buffered, written in bulk by flush_token_heartbeats
+      touch_token(dt, _existing.name, _existing.last_updated)
       return frappe.get_doc(dt, _existing.name)
 
   d = frappe.get_doc(frappe._dict(
@@ -132,11 +191,9 @@ def notify_via_fcm(title, body, data=None, roles=None, users=None, topics=None,
 
 
 def _notify_via_fcm(title, body, data=None, roles=None, users=None, topics=None, tokens=None):
-
-  users = set(users or [])
-  if roles:
-    users.union(set([x.parent for x in frappe.db.get_all("Has Role", fields=[
-                "distinct parent"], filters={"role": ["IN", roles or []]})]))
+  """
+  Returns the number of successful and failed sends over all the targets
+  """
 
   if data == None:
     data = frappe._dict()
@@ -146,18 +203,38 @@ def _notify_via_fcm(title, body, data=None, roles=None, users=None, topics=None,
   else:
     data = frappe._dict(data)
 
-  for user in users:
-    send_notification_to_user(user, title=title, body=body, data=data)
+  notification_log = NotificationLog()
+  counts = frappe._dict(success_count=0, failure_count=0)
+
+  def add_counts(response):
+    if response:
+      counts.success_count += response.success_count
+      counts.failure_count += response.failure_count
+
+  # Mirrored roles are sent to via their topics, the rest are expanded to their users
+  topic_roles, roles = split_topic_roles(roles)
+  if len(topic_roles):
+    add_counts(send_notification_to_roles(topic_roles, title=title, body=body,
+                                          data=frappe._dict(data), notification_log=notification_log))
+
+  if users or roles:
+    r = resolve_tokens("FCM User Token", users=users, roles=roles)
+    add_counts(send_notification_to_users(
+        r.user_tokens, title=title, body=body, data=data, notification_log=notification_log))
 
   topics = set(topics or [])
   for topic in topics:
-    send_notification_to_topic(topic=topic, title=title, body=body, data=data)
+    add_counts(send_notification_to_topic(topic=topic, title=title, body=body,
+                                          data=frappe._dict(data), notification_log=notification_log))
 
   tokens = set(tokens or [])
   if len(tokens):
-    send_fcm_notifications(list(tokens), title=title, body=body, data=data)
+    add_counts(send_fcm_notifications(list(tokens), title=title, body=body, data=data))
+
+  notification_log.flush()
+  return counts
 
-def send_notification_to_topic(topic, title, body, data=None):
+def send_notification_to_topic(topic, title, body, data=None, notification_log=None):
   if not data:
     data = frappe._dict({})
 
@@ -167,31 +244,119 @@ def send_notification_to_topic(topic, title, body, data=None):
   response = send_fcm_notifications(
       topic=topic, title=title, body=body, data=data)
   if response:
-    make_communication_doc(data.message_id, title, body, data, topic=topic)
+    if notification_log:
+      notification_log.add(data.message_id, title, body, data, topic=topic)
+    else:
+      make_communication_doc(data.message_id, title, body, data, topic=topic)
 
-def send_notification_to_user(user, title, body, data=None):
-  tokens = get_tokens_for("Users", users=[user])
+  return response
+
+def send_notification_to_roles(roles, title, body, data=None, notification_log=None):
+  """
+  Sends to the topics mirroring the roles, combined into FCM conditions
+  so that a device in many of the roles is notified once per condition
 
+  The notification is saved against every user of the roles, as when sent to them one by one,
+  so that it shows up in their notifications and counts
+  """
   if not data:
     data = frappe._dict({})
-  # for saving purpose
-  data.message_id = "FCM-{}-{}".format(user,
-                                       make_autoname("hash", "Communication"))
 
-  # Batch Response
-  response = send_fcm_notifications(
-      tokens=tokens, title=title, body=body, data=data)
-  if response and response.success_count > 0:
-    make_communication_doc(data.message_id, title, body, data, user=user)
+  log = notification_log or NotificationLog()
+  logged_users = set()
+  responses = []
+  for _roles in get_chunks(sorted(set(roles)), FCM_MAX_CONDITION_TOPICS):
+    condition = get_topic_condition([get_role_topic(x) for x in _roles])
+    _data = frappe._dict(data)
+    _data.message_id = "FCM-{}-{}".format("roles",
+                                          make_autoname("hash", "Communication"))
+    response = send_fcm_notifications(
+        condition=condition, title=title, body=body, data=_data)
+    if not response:
+      continue
+
+    responses.extend(response.responses)
+    if not response.success_count:
+      continue
+    for user in get_role_users(_roles):
+      if user not in logged_users:
+        logged_users.add(user)
+        log.add(_data.message_id, title, body, _data, user=user)
+
+  if not notification_log:
+    log.flush()
+
+  return messaging.BatchResponse(responses)
+
+def send_notification_to_user(user, title, body, data=None):
+  send_notification_to_users(
+      {user: get_tokens_for("Users", users=[user])}, title=title, body=body, data=data)
+
+def send_notification_to_users(user_tokens, title, body, data=None, notification_log=None):
+  """
+  Sends the notification to every token of every user in FCM sized batches
+  Each user gets its own message_id so that the notification can be saved against the user
+
+  :param user_tokens: { user: [tokens] }
+  :param notification_log: NotificationLog to collect the Communications in, flushed here if not given
+  """
+  noti = messaging.Notification(title=title, body=body)
+  messages = []
+  recipients = []
+  user_data = frappe._dict()
+  for user, tokens in user_tokens.items():
+    if not tokens:
+      continue
+
+    _data = frappe._dict(data or {})
+    # for saving purpose
+    _data.message_id = "FCM-{}-{}".format(user,
+                                          make_autoname("hash", "Communication"))
+    user_data[user] = _data
+    for t in tokens:
+      messages.append(messaging.Message(token=t, notification=noti, data=_data))
+      recipients.append((user, t))
+
+  if not len(messages):
+    return
+
+  tokens = [x[1] for x in recipients]
+  print("Sending to {} tokens of {} users".format(len(tokens), len(user_data)))
+  response = send_fcm_messages(messages)
+  print("FCM Response: Success: {} Failed: {} ".format(
+      response.success_count, response.failure_count))
+  fcm_error_handler(tokens=tokens, title=title, body=body, data=data,
+                    responses=response.responses, recipient_count=len(tokens), success_count=response.success_count)
+  delete_invalid_tokens(tokens, response.responses)
+
+  log = notification_log or NotificationLog()
+  notified_users = set()
+  for (user, t), r in zip(recipients, response.responses):
+    if r.success and user not in notified_users:
+      notified_users.add(user)
+      log.add(user_data[user].message_id, title,
+              body, user_data[user], user=user)
+  if not notification_log:
+    log.flush()
+
+  return response
 
 def make_communication_doc(message_id, title, body, data, user=None, topic=None):
+  doc = frappe.get_doc(get_communication_dict(
+      message_id, title, body, data, user=user, topic=topic))
+  doc.insert(ignore_permissions=True)
+  if user:
+    update_notification_counters({user: (1, 1)})
+
+
+def get_communication_dict(message_id, title, body, data, user=None, topic=None):
   notification_str = json.dumps({
       "title": title or "",
       "body": body or "",
       "data": data or {}
   })
 
-  doc = frappe.get_doc({
+  return frappe._dict({
       "message_id": data.message_id,
       "subject": "{} {} {}".format("FCM" if 'FCM' in message_id else "HPK" , user or topic, title or ""),
       "doctype": "Communication",
@@ -201,121 +366,240 @@ def make_communication_doc(message_id, title, body, data, user=None, topic=None)
       "text_content": notification_str,
       "user": user
   })
-  doc.insert(ignore_permissions=True)
+
+
+class NotificationLog(object):
+  """
+  Collects the Communications of sent push notifications
+  and writes them with multi-row inserts, skipping the Document hooks
+
+  log = NotificationLog()
+  log.add(message_id, title, body, data, user=user)
+  log.flush()
+  """
+
+  def __init__(self, batch_size=COMMUNICATION_BATCH_SIZE):
+    self.batch_size = batch_size
+    self.records = []
+
+  def add(self, message_id, title, body, data, user=None, topic=None):
+    self.records.append(get_communication_dict(
+        message_id, title, body, data, user=user, topic=topic))
+    if len(self.records) >= self.batch_size:
+      self.flush()
+
+  def flush(self):
+    if not len(self.records):
+      return
+
+    fields = ["name", "creation", "modified", "owner", "modified_by", "docstatus",
+              "communication_date", "communication_type", "status", "seen", "disable",
+              "message_id", "subject", "communication_medium", "sent_or_received",
+              "content", "text_content", "user"]
+    ts = now()
+    values = []
+    for r in self.records:
+      values.append((
+          make_autoname("hash", "Communication"), ts, ts, frappe.session.user, frappe.session.user, 0,
+          ts, "Communication", "Open", 0, 0,
+          r.message_id, r.subject, r.communication_medium, r.sent_or_received,
+          r.content, r.text_content, r.user
+      ))
+
+    frappe.db.bulk_insert("Communication", fields=fields, values=values)
+
+    user_counts = frappe._dict()
+    for r in self.records:
+      if r.user:
+        total = user_counts.get(r.user, (0, 0))[0] + 1
+        user_counts[r.user] = (total, total)
+    update_notification_counters(user_counts)
+    self.records = []
 
 
 def get_tokens_for(target, roles=None, users=None):
   if target == "Roles":
-    users = [x.parent for x in frappe.db.get_all(
-        "Has Role", fields=["distinct parent"], filters={"role": ["IN", roles or []]})]
-    target = "Users"
-
-  if target != "Users":
+    users = None
+  elif target == "Users":
+    roles = None
+  else:
     frappe.throw("Invalid Target")
 
-  tokens = []
-  for u in users:
-    tokens.extend(get_client_tokens(user=u))
+  return resolve_tokens("FCM User Token", users=users, roles=roles).tokens
+
+def get_firebase_app(worker=0):
+  """
+  Returns the firebase_admin app of the current site
+  Apps are created once per site and process, and re-created when the site's credentials change
 
-  return [x for x in tokens if len(x) > 0]
+  The messaging service of an app holds a single httplib2 transport, which is not thread safe,
+  so every worker thread of send_fcm_messages gets an app of its own
+  """
+  site = frappe.local.site
+  cred = get_firebase_credentials()
+  fingerprint = get_credentials_fingerprint(cred)
+
+  registered = _firebase_apps.get(site)
+  if registered and registered.fingerprint != fingerprint:
+    for app in registered.apps.values():
+      firebase_admin.delete_app(app)
+    registered = None
+
+  if not registered:
+    registered = _firebase_apps[site] = frappe._dict(fingerprint=fingerprint, apps={})
+
+  if worker not in registered.apps:
+    name = "{}-{}".format(site, fingerprint[:16])
+    if worker:
+      name = "{}-{}".format(name, worker)
+    try:
+      app = firebase_admin.get_app(name)
+    except ValueError:
+      app = firebase_admin.initialize_app(credentials.Certificate(cred), name=name)
+    registered.apps[worker] = app
 
-def send_fcm_notifications(tokens=None, topic=None, title=None, body=None, data=None):
-  global firebase_app
-  if not firebase_app:
-    firebase_app = firebase_admin.initialize_app(get_firebase_certificate())
+  return registered.apps[worker]
 
+def send_fcm_messages(messages, dry_run=False):
+  """
+  Sends the messages in batches of FCM_BATCH_SIZE over a bounded thread pool
+  Every thread sends its share of the batches with its own firebase_app
+
+  Returns a single BatchResponse, its responses are in the same order as the messages
+  """
+  from concurrent.futures import ThreadPoolExecutor
+
+  batches = get_chunks(messages, FCM_BATCH_SIZE)
+  if not len(batches):
+    return messaging.BatchResponse([])
+
+  max_workers = min(len(batches), cint(
+      frappe.conf.get("fcm_max_workers")) or FCM_MAX_WORKERS)
+  apps = [get_firebase_app(worker=i) for i in range(max_workers)]
+
+  def _send(worker):
+    results = []
+    for i in range(worker, len(batches), max_workers):
+      batch = batches[i]
+      try:
+        results.append((i, messaging.send_all(messages=batch, dry_run=dry_run, app=apps[worker]).responses))
+      except ValueError:
+        # Invalid arguments, not a failure of the request
+        raise
+      except Exception as exc:
+        # The whole batch failed, mark every message in it as failed
+        results.append((i, [messaging.SendResponse(None, exc) for _ in batch]))
+    return results
+
+  batch_responses = {}
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    for results in executor.map(_send, range(max_workers)):
+      batch_responses.update(results)
+
+  responses = []
+  for i in range(len(batches)):
+    responses.extend(batch_responses[i])
+  return messaging.BatchResponse(responses)
+
+def send_fcm_notifications(tokens=None, topic=None, title=None, body=None, data=None, condition=None):
   noti = messaging.Notification(title=title, body=body)
   response = None
   if tokens and len(tokens):
-    print("Sending to tokens: {}".format(tokens))
-    multicast_msg = messaging.MulticastMessage(
-        tokens=tokens, notification=noti, data=data)
-    # send_multicast returns a BatchResponse
-    # https://firebase.google.com/docs/reference/admin/python/firebase_admin.messaging#firebase_admin.messaging.BatchResponse
-    response = messaging.send_multicast(
-        multicast_message=multicast_msg, app=firebase_app)
+    print("Sending to {} tokens".format(len(tokens)))
+    response = send_fcm_messages(
+        [messaging.Message(token=t, notification=noti, data=data) for t in tokens])
     print("FCM Response: Success: {} Failed: {} ".format(
         response.success_count, response.failure_count))
     fcm_error_handler(tokens=tokens, topic=topic, title=title, body=body, data=data,
                       responses=response.responses, recipient_count=len(tokens), success_count=response.success_count)
     delete_invalid_tokens(tokens, response.responses)
-  elif topic:
-    message = messaging.Message(topic=topic, notification=noti, data=data)
-    response = messaging.send_all(messages=[message], app=firebase_app)
-    print("Sent TOPIC {} Msg: {}".format(topic, response))
-    fcm_error_handler(tokens=tokens, topic=topic, title=title, body=body, data=data,
+  elif topic or condition:
+    message = messaging.Message(topic=topic, condition=condition, notification=noti, data=data)
+    response = messaging.send_all(messages=[message], app=get_firebase_app())
+    print("Sent TOPIC {} Msg: {}".format(topic or condition, response))
+    fcm_error_handler(tokens=tokens, topic=topic or condition, title=title, body=body, data=data,
                       responses=response.responses, recipient_count=1, success_count=0)
 
   return response
 
 def delete_invalid_tokens(tokens, responses):
   """
-  Responses dont give a hint of what token was used
-  And we arent guaranteed if input token list and responses list match one to one
+  Responses are expected in the same order as the tokens they were sent to
+  Tokens reported as not registered are confirmed with batched dry runs
+  and the confirmed ones are deleted in bulk
   """
   if len(tokens) != len(responses):
     return
 
-  err_tokens = []
-  i = 0
-  for i in range(len(responses)):
-    r = responses[i]
-    if r.success:
-      continue
+  err_tokens = [t for t, r in zip(tokens, responses) if is_invalid_token_response(r)]
+  if not len(err_tokens):
+    return
 
-    exc = getattr(r, "exception")
-    if not exc:
-      continue
+  # now lets dry run and confirm exceptions
+  noti = messaging.Notification(title="Test", body="Test")
+  response = send_fcm_messages(
+      [messaging.Message(notification=noti, token=t) for t in err_tokens], dry_run=True)
 
-    code = getattr(exc, "code")
-    if not code or code not in ["registration-token-not-registered"]:
-      continue
+  # now all tokens in err tokens are problematic
+  err_tokens = [t for t, r in zip(err_tokens, response.responses) if is_invalid_token_response(r)]
+  if not len(err_tokens):
+    return
 
-    err_tokens.append(tokens[i])
+  for dt in TOKEN_DOCTYPES:
+    delete_tokens(dt, tokens=err_tokens)
 
-  # now lets dry run and confirm exceptions
-  global firebase_app
-  if not firebase_app:
-    firebase_app = firebase_admin.initialize_app(get_firebase_certificate())
-  noti = messaging.Notification(title="Test", body="Test")
 
-  i = len(err_tokens) - 1
-  while i >= 0:
-    t = err_tokens[i]
-    msg = messaging.Message(notification=noti, token=t)
-    try:
-      # dry run!
-      r = messaging.send(msg, dry_run=True, app=firebase_app)
-      err_tokens.pop(i)
-    except:
-      pass
-    i -= 1
+def is_invalid_token_response(response):
+  if response.success:
+    return False
 
-  # now all tokens in err tokens are problematic
-  user_token = frappe._dict()
-  for t in err_tokens:
-    t = frappe.db.get_value("FCM User Token", {"token": t})
-    if t:
-      frappe.delete_doc("FCM User Token", t, ignore_permissions=True)
+  exc = getattr(response, "exception", None)
+  return getattr(exc, "code", None) in FCM_INVALID_TOKEN_CODES
 
 
 def fcm_error_handler(tokens=None, topic=None, title=None, body=None, data=None, responses=[], recipient_count=1, success_count=0):
-  preMessage = "Tokens: {}\nTopic: {}\nTitle: {}\nBody: {}\nData: {}\n Success/Recipients: {}/{}".format(
-      tokens, topic, title, body, data, success_count, recipient_count)
-  for r in responses:
+  """
+  Logs all the failures of a batch in a single Error Log, grouped by the error code
+  """
+  failures = frappe._dict()
+  tokens_match = tokens and len(tokens) == len(responses or [])
+  for i, r in enumerate(responses or []):
     if getattr(r, "success", False):
       continue
 
     exc = getattr(r, "exception", r)
     code = getattr(exc, "code", "no-code")
-    message = getattr(exc, "message", exc)
-    detail = getattr(exc, "detail", "no-details")
-    print("- EXC\nCode: {}\nMessage: {}\nDetail: {}".format(code, message, detail))
-    frappe.log_error(
-        title="FCM Error", message="{}\n- EXC\nCode: {}\nMessage: {}\nDetail: {}".format(preMessage, code, message, detail))
+    f = failures.setdefault(code, frappe._dict(
+        message=getattr(exc, "message", exc),
+        detail=getattr(exc, "detail", "no-details"),
+        count=0,
+        tokens=[]
+    ))
+    f.count += 1
+    if tokens_match:
+      f.tokens.append(tokens[i])
+
+  if not len(failures):
+    return
+
+  preMessage = "Tokens: {}\nTopic: {}\nTitle: {}\nBody: {}\nData: {}\n Success/Recipients: {}/{}".format(
+      len(tokens or []), topic, title, body, data, success_count, recipient_count)
+  excs = []
+  for code, f in failures.items():
+    excs.append("- EXC\nCode: {}\nMessage: {}\nDetail: {}\nCount: {}\nTokens: {}".format(
+        code, f.message, f.detail, f.count, f.tokens))
+  print("\n".join(excs))
+  frappe.log_error(
+      title="FCM Error", message="{}\n{}".format(preMessage, "\n".join(excs)))
 
 @frappe.whitelist(allow_guest=True)
-def get_user_notifications(limit_start=0, limit_page_length=20, _user=None, just_unseen=None, filters=None):
+def get_user_notifications(limit_start=0, limit_page_length=20, _user=None, just_unseen=None, filters=None,
+                           cursor=None):
+  """
+  Returns the notifications of the user, latest first
+  Every notification carries a cursor; pass the cursor of the last notification
+  to get the next page by keyset instead of limit_start offsets
+  """
   user = _user or frappe.session.user
 
   _filters = filters or frappe._dict()
@@ -328,14 +612,18 @@ def get_user_notifications(limit_start=0, limit_page_length=20, _user=None, just
   if not just_unseen is None:
     _filters["seen"] = cint(just_unseen)
 
-  communications = frappe.get_all("Communication",
-                                  fields=["message_id", "text_content",
-                                          "seen", "communication_date"],
-                                  filters=_filters,
-                                  order_by="communication_date desc",
-                                  limit_start=limit_start,
-                                  limit_page_length=limit_page_length
-                                  )
+  fields = ["name", "message_id", "text_content", "seen", "communication_date"]
+  if cursor:
+    communications = get_notifications_after(
+        cursor, fields=fields, filters=_filters, limit_page_length=cint(limit_page_length))
+  else:
+    communications = frappe.get_all("Communication",
+                                    fields=fields,
+                                    filters=_filters,
+                                    order_by="communication_date desc, name desc",
+                                    limit_start=limit_start,
+                                    limit_page_length=limit_page_length
+                                    )
 
   ret = []
   for comm in communications:
@@ -343,27 +631,108 @@ def get_user_notifications(limit_start=0, limit_page_length=20, _user=None, just
     data.message_id = comm.message_id
     data.seen = comm.seen
     data.communication_date = comm.communication_date
+    data.cursor = "{}|{}".format(comm.communication_date, comm.name)
     ret.append(data)
 
   return ret
 
 
+def get_notifications_after(cursor, fields, filters, limit_page_length=20):
+  """
+  Keyset pagination on (communication_date, name)
+  First the rest of the notifications on the same communication_date as the cursor,
+  then the ones before it
+  """
+  communication_date, name = cursor.rsplit("|", 1)
+  order_by = "communication_date desc, name desc"
+
+  communications = frappe.get_all("Communication", fields=fields,
+                                  filters=dict(filters, communication_date=communication_date,
+                                               name=["<", name]),
+                                  order_by=order_by, limit_page_length=limit_page_length)
+  if len(communications) < limit_page_length:
+    communications.extend(frappe.get_all("Communication", fields=fields,
+                                         filters=dict(filters, communication_date=[
+                                                      "<", communication_date]),
+                                         order_by=order_by,
+                                         limit_page_length=limit_page_length - len(communications)))
+
+  return communications
+
+
 @frappe.whitelist()
-def mark_all_as_disable(_user=None, filters=None):
-  user = _user or frappe.session.user
+def get_notification_counts(_user=None):
+  """
+  Returns the total and unseen notification counts of the user from redis
+  Counted from the database only when the counter is not in redis
+  """
+  user = get_notification_user(_user)
+  key = _get_notification_counter_key(user)
 
-  _filters = filters or frappe._dict()
+  pipe = frappe.cache().pipeline()
+  pipe.hgetall(key)
+  counts = {frappe.safe_decode(k): cint(v) for k, v in (pipe.execute()[0] or {}).items()}
+  if "total" in counts and "unseen" in counts:
+    return frappe._dict(total=counts["total"], unseen=counts["unseen"])
 
-  _filters.update({
-      "communication_medium": "FCM",
-      "user": user,
-      "ifnull(disable, 0)": 0
-  })
-  names = frappe.get_all('Communication', _filters)
-  if names:
-    frappe.db.set_value('Communication', {'name': (
-        'in', [x.name for x in names])}, 'disable', 1, update_modified=False)
-  return 'Success'
+  total, unseen = frappe.db.sql("""
+    SELECT COUNT(*), SUM(CASE WHEN seen = 0 THEN 1 ELSE 0 END)
+    FROM `tabCommunication`
+    WHERE communication_medium = 'FCM' AND user = %(user)s AND IFNULL(disable, 0) = 0
+  """, {"user": user})[0]
+  counts = frappe._dict(total=cint(total), unseen=cint(unseen))
+
+  pipe.hset(key, "total", counts.total)
+  pipe.hset(key, "unseen", counts.unseen)
+  pipe.expire(key, NOTIFICATION_COUNTER_EXPIRY)
+  pipe.execute()
+
+  return counts
+
+
+def get_notification_user(_user=None):
+  """
+  _user is honoured only for the Administrator and System Managers
+  """
+  if _user and (frappe.session.user == "Administrator" or "System Manager" in frappe.get_roles()):
+    return _user
+  return frappe.session.user
+
+
+def update_notification_counters(user_counts):
+  """
+  Increments the counters of the users that are already counted in redis
+  Counters not in redis are left to be counted by get_notification_counts
+
+  :param user_counts: { user: (total, unseen) }
+  """
+  pipe = frappe.cache().pipeline()
+  for user, (total, unseen) in user_counts.items():
+    pipe.eval(_NOTIFICATION_COUNTER_INCR, 1,
+              _get_notification_counter_key(user), cint(total), cint(unseen))
+  pipe.execute()
+
+
+def clear_notification_counters(users):
+  pipe = frappe.cache().pipeline()
+  for user in users:
+    pipe.delete(_get_notification_counter_key(user))
+  pipe.execute()
+
+
+def _get_notification_counter_key(user):
+  return frappe.cache().make_key("{}|{}".format(NOTIFICATION_COUNTER_KEY, user))
+
+
+@frappe.whitelist()
+def mark_all_as_disable(_user=None, filters=None):
+  user = get_notification_user(_user)
+
+  count = update_user_notifications(
+      user, "disable", 1, condition="IFNULL(disable, 0) = 0", filters=filters)
+  if count:
+    clear_notification_counters([user])
+  return count
 
 
 @frappe.whitelist()
@@ -373,27 +742,26 @@ def mark_notification_disable(message_id):
 
 @frappe.whitelist()
 def toggle_notification_disable(message_id, disable=1):
-  frappe.db.set_value('Communication', {
-                      "message_id": message_id}, 'disable', disable, update_modified=False)
+  comm = get_notification(message_id, ["name", "user"])
+  if not comm:
+    return 'Success'
+
+  frappe.db.set_value('Communication', comm.name, 'disable',
+                      disable, update_modified=False)
+  if comm.user:
+    clear_notification_counters([comm.user])
   return 'Success'
 
 
 @frappe.whitelist()
 def mark_all_as_read(_user=None, filters=None):
-  user = _user or frappe.session.user
+  user = get_notification_user(_user)
 
-  _filters = filters or frappe._dict()
-
-  _filters.update({
-      "communication_medium": "FCM",
-      "user": user,
-      "seen": 0
-  })
-  names = frappe.get_all('Communication', _filters)
-  if names:
-    frappe.db.set_value('Communication', {'name': (
-        'in', [x.name for x in names])}, 'seen', 1, update_modified=False)
-  return 'Success'
+  count = update_user_notifications(
+      user, "seen", 1, condition="seen = 0", filters=filters)
+  if count:
+    clear_notification_counters([user])
+  return count
 
 
 @frappe.whitelist()
@@ -403,13 +771,110 @@ def mark_notification_seen(message_id, seen=True):
   else:
     seen = 0
 
-  comm = frappe.db.get_value("Communication", fieldname="name", filters={
-                             "message_id": message_id})
-  frappe.db.set_value("Communication", comm, "seen", seen)
+  comm = get_notification(message_id, ["name", "user", "seen", "disable"])
+  if not comm:
+    return "OK"
+
+  frappe.db.set_value("Communication", comm.name, "seen", seen)
+  if comm.user and not cint(comm.disable) and cint(comm.seen) != seen:
+    update_notification_counters({comm.user: (0, -1 if seen else 1)})
   return "OK"
 
 
+@frappe.whitelist()
+def mark_notifications_seen(message_ids, seen=True, _user=None):
+  """
+  Batch form of mark_notification_seen
+  Returns the number of updated notifications
+  """
+  user = get_notification_user(_user)
+  message_ids = frappe.parse_json(message_ids)
+  if isinstance(message_ids, string_types):
+    message_ids = [message_ids]
+  seen = 1 if cint(seen) else 0
+
+  count = 0
+  for _message_ids in get_chunks(set(message_ids or []), NOTIFICATION_UPDATE_CHUNK_SIZE):
+    frappe.db.sql("""
+      UPDATE `tabCommunication` SET seen = %(seen)s
+      WHERE message_id IN %(message_ids)s AND user = %(user)s AND seen != %(seen)s
+    """, {"message_ids": tuple(_message_ids), "user": user, "seen": seen})
+    count += frappe.db._cursor.rowcount
+
+  if count:
+    clear_notification_counters([user])
+  return count
+
+
+def get_notification(message_id, fields):
+  """
+  Huawei notifications sent to many users share the same message_id,
+  so the notification of the current user is preferred
+  """
+  return frappe.db.get_value("Communication", {"message_id": message_id, "user": frappe.session.user},
+                             fields, as_dict=1) or \
+      frappe.db.get_value("Communication", {"message_id": message_id}, fields, as_dict=1)
+
+
+def update_user_notifications(user, fieldname, value, condition, filters=None):
+  """
+  Sets fieldname on the FCM Communications of the user matching the condition,
+  without fetching them, in UPDATEs of at most NOTIFICATION_UPDATE_CHUNK_SIZE rows
+  Additional filters are resolved by walking the matching names in primary key order
+
+  Returns the number of updated notifications
+  """
+  filters = frappe.parse_json(filters) if filters else None
+  count = 0
+  if filters:
+    _filters = frappe._dict(filters)
+    _filters.update({
+        "communication_medium": "FCM",
+        "user": user,
+        fieldname: ["!=", value]
+    })
+    last_name = ""
+    while True:
+      names = [x.name for x in frappe.get_all("Communication",
+                                              filters=dict(_filters, name=[">", last_name]),
+                                              order_by="name asc",
+                                              limit_page_length=NOTIFICATION_UPDATE_CHUNK_SIZE)]
+      if not len(names):
+        break
+
+      frappe.db.sql("""
+        UPDATE `tabCommunication` SET `{fieldname}` = %(value)s
+        WHERE name IN %(names)s
+      """.format(fieldname=fieldname), {"value": value, "names": tuple(names)})
+      count += frappe.db._cursor.rowcount
+      last_name = names[-1]
+
+    return count
+
+  limit = ""
+  if frappe.db.db_type == "mariadb":
+    limit = "LIMIT {}".format(NOTIFICATION_UPDATE_CHUNK_SIZE)
+  while True:
+    frappe.db.sql("""
+      UPDATE `tabCommunication` SET `{fieldname}` = %(value)s
+      WHERE communication_medium = 'FCM' AND user = %(user)s AND {condition}
+      {limit}
+    """.format(fieldname=fieldname, condition=condition, limit=limit),
+        {"value": value, "user": user})
+    updated = frappe.db._cursor.rowcount
+    count += updated
+    if not limit or updated < NOTIFICATION_UPDATE_CHUNK_SIZE:
+      break
+    # release the locks of the chunk before moving on
+    frappe.db.commit()
+
+  return count
+
+
 def delete_token_on_logout():
+  # Tokens linked to the session being logged out are no longer valid
+  unindex_session(user=frappe.session.user, sid=frappe.session.sid)
+
   if not frappe.local.form_dict.fcm_token:
     return
 
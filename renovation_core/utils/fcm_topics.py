@@ -0,0 +1,256 @@
+import re
+
+import frappe
+from firebase_admin import messaging
+from six import string_types
+
+from .device_tokens import QUERY_CHUNK_SIZE, get_chunks
+
+"""
+Role Topics
+FCM topic memberships that mirror the roles of the token owners,
+so that a notification to a role is a single topic send instead of a fan-out to its users
+
+Mirrored roles are configured in site_config
+  "fcm_topic_roles": ["All", "Sales User"]
+  "fcm_topic_prefix": "mysite-"   (when many sites share a firebase project)
+
+The implicit roles All and Guest can be mirrored too, Guest covering the tokens of guests as well
+
+Memberships are kept in sync by
+- FCM User Token registration and deletion
+- Role changes of a User
+- sync_role_topics on migrate, for newly mirrored roles
+
+A role is sent to via its topic only after it is synced
+  fcm_role_topics_synced: set of synced roles
+"""
+
+# FCM accepts at most 1000 tokens in a single subscribe / unsubscribe call
+FCM_TOPIC_BATCH_SIZE = 1000
+# FCM conditions can combine at most 5 topics
+FCM_MAX_CONDITION_TOPICS = 5
+ROLE_TOPICS_SYNCED_KEY = "fcm_role_topics_synced"
+
+
+def get_topic_roles():
+  roles = frappe.conf.get("fcm_topic_roles") or []
+  if isinstance(roles, string_types):
+    roles = [roles]
+  return list(roles)
+
+
+def get_role_topic(role):
+  """
+  FCM topic names can only have [a-zA-Z0-9-_.~%]
+  """
+  return "{}role_{}".format(frappe.conf.get("fcm_topic_prefix") or "",
+                            re.sub(r"[^a-zA-Z0-9\-_.~%]", "_", role))
+
+
+def get_synced_topic_roles():
+  """
+  Returns the mirrored roles whose topics are ready to be sent to
+  """
+  synced = frappe.cache().smembers(ROLE_TOPICS_SYNCED_KEY) or []
+  synced = set(frappe.safe_decode(x) for x in synced)
+  return [x for x in get_topic_roles() if x in synced]
+
+
+def split_topic_roles(roles):
+  """
+  Splits the roles into the ones that can be sent to via topics and the rest
+  Returns (topic_roles, other_roles)
+  """
+  roles = set(roles or [])
+  if not len(roles):
+    return [], []
+
+  synced = set(get_synced_topic_roles())
+  return [x for x in roles if x in synced], [x for x in roles if x not in synced]
+
+
+def get_topic_condition(topics):
+  """
+  A condition matching the devices subscribed to any of the topics,
+  so that a device in many of them is notified only once
+  """
+  return " || ".join("'{}' in topics".format(x) for x in topics)
+
+
+def get_topic_conditions(topics):
+  return [get_topic_condition(x) for x in get_chunks(sorted(set(topics)), FCM_MAX_CONDITION_TOPICS)]
+
+
+def subscribe_tokens(topic, tokens):
+  return _update_topic_membership(messaging.subscribe_to_topic, topic, tokens)
+
+
+def unsubscribe_tokens(topic, tokens):
+  return _update_topic_membership(messaging.unsubscribe_from_topic, topic, tokens)
+
+
+def _update_topic_membership(fn, topic, tokens):
+  """
+  Calls subscribe_to_topic / unsubscribe_from_topic in batches of FCM_TOPIC_BATCH_SIZE
+  Failures are logged in a single Error Log
+
+  Returns frappe._dict(success_count, failure_count)
+  """
+  from .fcm import get_firebase_app
+
+  tokens = list(set(tokens or []))
+  r = frappe._dict(success_count=0, failure_count=0)
+  if not len(tokens):
+    return r
+
+  app = get_firebase_app()
+  errors = frappe._dict()
+  for batch in get_chunks(tokens, FCM_TOPIC_BATCH_SIZE):
+    try:
+      response = fn(batch, topic, app=app)
+    except Exception as e:
+      r.failure_count += len(batch)
+      errors.setdefault(str(e), []).extend(batch)
+      continue
+
+    r.success_count += response.success_count
+    r.failure_count += response.failure_count
+    for err in response.errors:
+      errors.setdefault(err.reason, []).append(batch[err.index])
+
+  if len(errors):
+    frappe.log_error(title="FCM Topic Error", message="Topic: {}\n{}: {}/{}\n{}".format(
+        topic, fn.__name__, r.success_count, len(tokens),
+        "\n".join("- {}\nTokens: {}".format(k, v) for k, v in errors.items())))
+
+  return r
+
+
+def get_user_topic_roles(user, topic_roles=None):
+  if topic_roles is None:
+    topic_roles = get_topic_roles()
+  if not len(topic_roles):
+    return []
+
+  return [x for x in frappe.get_roles(user) if x in topic_roles]
+
+
+def sync_token_topics(tokens):
+  """
+  Brings the topic memberships of the tokens in line with the roles of their current owners
+  Deleted tokens are unsubscribed from all the role topics
+
+  Idempotent, the state is read from the database when the job runs
+  """
+  topic_roles = get_topic_roles()
+  tokens = list(set(tokens or []))
+  if not len(topic_roles) or not len(tokens):
+    return
+
+  owners = frappe._dict()
+  for _tokens in get_chunks(tokens, QUERY_CHUNK_SIZE):
+    owners.update({x.token: x.user for x in frappe.get_all(
+        "FCM User Token", filters={"token": ["in", _tokens]}, fields=["token", "user"])})
+
+  user_roles = frappe._dict()
+  for user in set(owners.values()):
+    user_roles[user] = set(get_user_topic_roles(user, topic_roles))
+
+  for role in topic_roles:
+    subscribe = [t for t in tokens if t in owners and role in user_roles[owners[t]]]
+    unsubscribe = [t for t in tokens if t not in subscribe]
+    topic = get_role_topic(role)
+    subscribe_tokens(topic, subscribe)
+    unsubscribe_tokens(topic, unsubscribe)
+
+
+def sync_user_topics(user, added_roles=None, removed_roles=None):
+  """
+  Updates the topic memberships of all the tokens of the user after a role change
+  """
+  topic_roles = get_topic_roles()
+  added_roles = [x for x in added_roles or [] if x in topic_roles]
+  removed_roles = [x for x in removed_roles or [] if x in topic_roles]
+  if not len(added_roles) and not len(removed_roles):
+    return
+
+  tokens = [x.token for x in frappe.get_all(
+      "FCM User Token", filters={"user": user}, fields=["token"])]
+  for role in added_roles:
+    subscribe_tokens(get_role_topic(role), tokens)
+  for role in removed_roles:
+    unsubscribe_tokens(get_role_topic(role), tokens)
+
+
+def sync_role_topics(roles=None):
+  """
+  Subscribes all the tokens of the users of the roles to the role topics
+  Roles are marked as synced so that they are sent to via their topic from then on
+
+  Called on migrate for the mirrored roles that are not synced yet
+  """
+  from .recipients import get_role_users
+
+  topic_roles = get_topic_roles()
+  cache = frappe.cache()
+  if roles is None:
+    synced = set(get_synced_topic_roles())
+    roles = [x for x in topic_roles if x not in synced]
+  roles = [x for x in roles if x in topic_roles]
+
+  for role in roles:
+    if role == "Guest":
+      filters = {}
+    elif role == "All":
+      filters = {"user": ["!=", "Guest"]}
+    else:
+      users = get_role_users([role])
+      if not len(users):
+        cache.sadd(ROLE_TOPICS_SYNCED_KEY, role)
+        continue
+      filters = {"user": ["in", users]}
+
+    tokens = [x.token for x in frappe.get_all(
+        "FCM User Token", filters=filters, fields=["token"])]
+    r = subscribe_tokens(get_role_topic(role), tokens)
+    print("Subscribed {}/{} tokens to the topic of {}".format(
+        r.success_count, len(tokens), role))
+    cache.sadd(ROLE_TOPICS_SYNCED_KEY, role)
+
+  # roles that are no longer mirrored must be synced again if mirrored later
+  synced = cache.smembers(ROLE_TOPICS_SYNCED_KEY) or []
+  for role in set(frappe.safe_decode(x) for x in synced):
+    if role not in topic_roles:
+      cache.srem(ROLE_TOPICS_SYNCED_KEY, role)
+
+
+def on_token_change(tokens):
+  """
+  Called when FCM User Tokens are created or deleted
+  """
+  if not len(get_topic_roles()):
+    return
+
+  frappe.enqueue("renovation_core.utils.fcm_topics.sync_token_topics",
+                 enqueue_after_commit=True, tokens=list(tokens))
+
+
+def on_user_roles_change(doc):
+  """
+  Called on User on_update, compares the roles against the ones before save
+  """
+  topic_roles = get_topic_roles()
+  if not len(topic_roles):
+    return
+
+  before = doc.get_doc_before_save()
+  old_roles = set(x.role for x in before.get("roles") or []) if before else set()
+  new_roles = set(x.role for x in doc.get("roles") or [])
+  added_roles = [x for x in new_roles - old_roles if x in topic_roles]
+  removed_roles = [x for x in old_roles - new_roles if x in topic_roles]
+  if not len(added_roles) and not len(removed_roles):
+    return
+
+  frappe.enqueue("renovation_core.utils.fcm_topics.sync_user_topics", enqueue_after_commit=True,
+                 user=doc.name, added_roles=added_roles, removed_roles=removed_roles)
@@ -4,15 +4,60 @@
 
 from __future__ import unicode_literals
 
+import time
+
 import frappe
 from frappe.integrations.utils import make_post_request
 from frappe.model.naming import make_autoname
-from renovation_core.utils.fcm import make_communication_doc, \
-  is_valid_session_id
+from frappe.utils import cint
+from renovation_core.utils.device_tokens import delete_tokens, get_chunks, \
+  resolve_tokens
+from renovation_core.utils.fcm import NotificationLog, make_communication_doc
+
+HPK_SEND_URL = "https://push-api.cloud.huawei.com/v1/{}/messages:send"
+# Push Kit accepts at most 1000 tokens in a single message
+HPK_BATCH_SIZE = 1000
+# Default number of batches sent in parallel, override with hpk_max_workers in site_config
+HPK_MAX_WORKERS = 8
+HPK_TIMEOUT = 30
+HPK_SUCCESS = "80000000"
+HPK_PARTIAL_SUCCESS = "80100000"
+# All the tokens of the message are invalid
+HPK_ALL_TOKENS_ILLEGAL = "80300007"
+
+# Auth tokens are refreshed when they have less than this many seconds left
+HPK_AUTH_REFRESH_MARGIN = 10 * 60
+HPK_AUTH_LOCK_KEY = "huawei_auth_token_lock"
+HPK_AUTH_LOCK_TIMEOUT = 30
+
+# One keep-alive session per site
+_sessions = {}
+# In-process cache of the auth token per site: { site: { token, expires_at } }
+_auth_tokens = {}
+
+
+def get_hpk_session():
+  import requests
+  site = frappe.local.site
+  if site not in _sessions:
+    _sessions[site] = requests.Session()
+  return _sessions[site]
+
+
+def get_hpk_config():
+  config = frappe.conf.get("huawei_push_kit_config")
+  if not config or not config.get('app_id') or not config.get(
+    'client_id') or not config.get('client_secret'):
+    frappe.log_error(
+      title="Huawei Push Kit Error",
+      message="Message: {}".format(frappe._("Missing secret keys in config")))
+    return
+  return config
 
 
 def send_huawei_notification_to_topic(topic, title, body, data=None,
-                                      custom_android_configuration=None):
+                                      custom_android_configuration=None,
+                                      notification_log=None):
   if not data:
     data = frappe._dict({})
 
@@ -23,18 +68,25 @@ def send_huawei_notification_to_topic(topic, title, body, data=None,
   response = send_huawei_notifications(
     topic=topic, title=title, body=body, data=data,
     custom_android_configuration=custom_android_configuration)
-  if response:
-    make_communication_doc(data.message_id, title, body, data, topic=topic)
+  if response and response.success_count:
+    if notification_log:
+      notification_log.add(data.message_id, title, body, data, topic=topic)
+    else:
+      make_communication_doc(data.message_id, title, body, data, topic=topic)
 
 
 def send_huawei_notifications(tokens=None, topic=None, title=None, body=None,
                               data=None, custom_android_configuration=None):
-  config = frappe.get_site_config().get("huawei_push_kit_config")
-  if not config or not config.get('app_id') or not config.get(
-    'client_id') or not config.get('client_secret'):
-    frappe.log_error(
-      title="Huawei Push Kit Error",
-      message="Message: {}".format(frappe._("Missing secret keys in config")))
+  """
+  Sends the message to the tokens in batches of HPK_BATCH_SIZE, or to the topic
+
+  Returns frappe._dict
+    - success_count, failure_count
+    - delivered: tokens the message was delivered to
+    - illegal_tokens: tokens rejected by Push Kit, deleted here
+  """
+  config = get_hpk_config()
+  if not config:
     return
   authorization_token = get_huawei_auth_token(config)
   if not authorization_token:
@@ -42,8 +94,6 @@ def send_huawei_notifications(tokens=None, topic=None, title=None, body=None,
       title="Huawei Push Kit Error",
       message="Message: {}".format(frappe._("Authorization token missing.")))
     return
-  url = "https://push-api.cloud.huawei.com/v1/{}/messages:send".format(
-    config.get('app_id'))
   # message format
   # {
   # data:str ,
@@ -69,80 +119,148 @@ def send_huawei_notifications(tokens=None, topic=None, title=None, body=None,
   if custom_android_configuration and isinstance(custom_android_configuration,
                                                  dict):
     message['android'].update(custom_android_configuration)
-  response = None
-  headers = {"Content-Type": "application/json",
-             "Authorization": authorization_token}
+
   if tokens and len(tokens):
-    message.update({"token": tokens})
-    try:
-      payload = frappe._dict(validate_only=False, message=message)
-      response = make_post_request(url, data=frappe.as_json(payload),
-                                   headers=headers)
-      huawei_push_kit_error_handler(tokens=tokens, topic=topic, title=title,
-                                    body=body,
-                                    data=data,
-                                    recipient_count=len(tokens),
-                                    request_params=message)
-    except Exception as exc:
-      huawei_push_kit_error_handler(tokens=tokens, topic=topic, title=title,
-                                    body=body,
-                                    data=data,
-                                    exc=exc,
-                                    recipient_count=len(tokens),
-                                    request_params=message)
-    print("Sending to tokens: {}".format(tokens))
+    print("Sending to {} tokens".format(len(tokens)))
+    payloads = [dict(message, token=batch)
+                for batch in get_chunks(tokens, HPK_BATCH_SIZE)]
   elif topic:
-    message.update({"topic": topic})
+    payloads = [dict(message, topic=topic)]
+  else:
+    return
+
+  response = send_hpk_messages(payloads, config, authorization_token)
+  print("HPK Response: Success: {} Failed: {}".format(
+    response.success_count, response.failure_count))
+  if len(response.illegal_tokens):
+    delete_huawei_invalid_tokens(response.illegal_tokens)
+  huawei_push_kit_error_handler(tokens=tokens, topic=topic, title=title,
+                                body=body, data=data,
+                                recipient_count=len(tokens or []) or 1,
+                                response=response)
+  return response
+
+
+def send_hpk_messages(messages, config, authorization_token):
+  """
+  Posts the messages over a bounded thread pool sharing the keep-alive session of the site
+  Only the HTTP calls are made in the threads
+
+  Returns the merged results of all the messages
+  """
+  from concurrent.futures import ThreadPoolExecutor
+
+  session = get_hpk_session()
+  url = HPK_SEND_URL.format(config.get('app_id'))
+  headers = {"Content-Type": "application/json",
+             "Authorization": authorization_token}
+  payloads = [(m, frappe.as_json(frappe._dict(validate_only=False, message=m)))
+              for m in messages]
+
+  def _post(request):
+    message, payload = request
     try:
-      payload = frappe._dict(validate_only=False, message=message)
-      response = make_post_request(url, data=frappe.as_json(payload),
-                                   headers=headers)
-      huawei_push_kit_error_handler(tokens=tokens, topic=topic, title=title,
-                                    body=body,
-                                    data=data,
-                                    request_params=message)
+      r = session.post(url, data=payload, headers=headers, timeout=HPK_TIMEOUT)
+      try:
+        return message, r.status_code, r.json(), None
+      except ValueError:
+        return message, r.status_code, None, None
     except Exception as exc:
-      huawei_push_kit_error_handler(tokens=tokens, topic=topic, title=title,
-                                    body=body,
-                                    data=data,
-                                    exc=exc,
-                                    request_params=message)
-    print("Sent TOPIC {} Msg: {}".format(topic, response))
+      return message, None, None, exc
+
+  max_workers = min(len(payloads), cint(
+    frappe.conf.get("hpk_max_workers")) or HPK_MAX_WORKERS)
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    results = list(executor.map(_post, payloads))
+
+  response = frappe._dict(success_count=0, failure_count=0, delivered=[],
+                          illegal_tokens=[], errors=[])
+  for message, status_code, r, exc in results:
+    tokens = message.get("token") or []
+    recipient_count = len(tokens) or 1
+    code = r.get("code") if isinstance(r, dict) else None
+    if code == HPK_SUCCESS:
+      response.success_count += recipient_count
+      response.delivered.extend(tokens)
+      continue
+
+    if code == HPK_PARTIAL_SUCCESS:
+      msg = frappe.parse_json(r.get("msg")) or {}
+      illegal_tokens = msg.get("illegal_tokens") or []
+      if isinstance(illegal_tokens, str):
+        illegal_tokens = frappe.parse_json(illegal_tokens) or []
+      response.success_count += msg.get("success", 0)
+      response.failure_count += msg.get("failure", 0)
+      response.illegal_tokens.extend(illegal_tokens)
+      response.delivered.extend(
+        [t for t in tokens if t not in set(illegal_tokens)])
+    elif code == HPK_ALL_TOKENS_ILLEGAL:
+      response.failure_count += recipient_count
+      response.illegal_tokens.extend(tokens)
+    else:
+      response.failure_count += recipient_count
+
+    response.errors.append(frappe._dict(
+      tokens=tokens, status_code=status_code, response=r, exc=exc))
+
   return response
 
 
 def get_huawei_tokens_for(target, roles=None, users=None):
   if target == "Roles":
-    users = [x.parent for x in frappe.db.get_all(
-      "Has Role", fields=["distinct parent"],
-      filters={"role": ["IN", roles or []]})]
-    target = "Users"
-
-  if target != "Users":
+    users = None
+  elif target == "Users":
+    roles = None
+  else:
     frappe.throw("Invalid Target")
 
-  tokens = []
-  for u in users:
-    tokens.extend(get_huawei_client_tokens(user=u))
-
-  return [x for x in tokens if len(x) > 0]
+  return resolve_tokens("Huawei User Token", users=users, roles=roles).tokens
 
 
 def send_huawei_notification_to_user(user, title, body, data=None,
-                                     custom_android_configuration=None):
-  tokens = get_huawei_tokens_for("Users", users=[user])
-  if not data:
-    data = frappe._dict({})
+                                     custom_android_configuration=None,
+                                     notification_log=None):
+  send_huawei_notification_to_users(
+    {user: get_huawei_tokens_for("Users", users=[user])}, title=title,
+    body=body, data=data,
+    custom_android_configuration=custom_android_configuration,
+    notification_log=notification_log)
+
+
+def send_huawei_notification_to_users(user_tokens, title, body, data=None,
+                                      custom_android_configuration=None,
+                                      notification_log=None):
+  """
+  Sends the notification to the tokens of all the users packed in HPK_BATCH_SIZE batches
+  Push Kit takes a single payload per message,
+  so the users of a send share the same message_id
+
+  :param user_tokens: { user: [tokens] }
+  """
+  token_user = frappe._dict()
+  for user, tokens in user_tokens.items():
+    for t in tokens or []:
+      token_user[t] = user
+  if not len(token_user):
+    return
+
+  data = frappe._dict(data or {})
   # for saving purpose
-  data.message_id = "HUAWEI-{}-{}".format(user,
-                                          make_autoname("hash",
-                                                        "Communication"))
+  data.message_id = "HUAWEI-{}".format(make_autoname("hash", "Communication"))
   # Batch Response
   response = send_huawei_notifications(
-    tokens=tokens, title=title, body=body, data=data,
+    tokens=list(token_user.keys()), title=title, body=body, data=data,
     custom_android_configuration=custom_android_configuration)
-  if response:
-    make_communication_doc(data.message_id, title, body, data, user=user)
+  if not response:
+    return
+
+  log = notification_log or NotificationLog()
+  for user in set(token_user[t] for t in response.delivered if t in token_user):
+    log.add(data.message_id, title, body, data, user=user)
+  if not notification_log:
+    log.flush()
+
+  return response
 
 
 def get_huawei_client_tokens(user=None):
@@ -151,34 +269,86 @@ def get_huawei_client_tokens(user=None):
   """
   if not user:
     user = frappe.session.user if frappe.session else "Guest"
-  tokens = []
-  for t in frappe.get_all("Huawei User Token",
-                          fields=["name", "token", "linked_sid"],
-                          filters={"user": user}):
-    if t.linked_sid and not is_valid_session_id(t.linked_sid):
-      frappe.delete_doc("Huawei User Token", t.name, ignore_permissions=True)
-      continue
-    tokens.append(t.token)
-  return tokens
+  return get_huawei_tokens_for("Users", users=[user])
 
 
 def delete_huawei_invalid_tokens(tokens):
-  for t in tokens:
-    t = frappe.db.get_value("Huawei User Token", {"token": t})
-    if t:
-      frappe.delete_doc("Huawei User Token", t, ignore_permissions=True)
+  delete_tokens("Huawei User Token", tokens=tokens)
 
 
 def get_huawei_auth_token(config):
+  """
+  Returns the auth token from the in-process cache, then from redis
+  The token is fetched here only when there is no valid token at all,
+  it is otherwise refreshed ahead of expiry by the scheduler
+  """
   if not config or not config.get('app_id') or not config.get(
     'client_id') or not config.get('client_secret'):
     frappe.log_error(
       title="Huawei Push Kit Error",
       message="Message: {}".format(frappe._("Missing secret keys in config")))
     return
-  cache_auth_token = check_redis_cache_for_huawei_auth_token()
-  if cache_auth_token:
-    return cache_auth_token
+
+  auth = _auth_tokens.get(frappe.local.site)
+  if not is_auth_token_valid(auth, margin=HPK_AUTH_REFRESH_MARGIN):
+    auth = check_redis_cache_for_huawei_auth_token()
+    if auth:
+      _auth_tokens[frappe.local.site] = auth
+
+  if is_auth_token_valid(auth):
+    return auth.token
+
+  return _refresh_huawei_auth_token(config, wait=True)
+
+
+def refresh_huawei_auth_token():
+  """
+  Refreshes the auth token when it is about to expire, so that sends never wait on the OAuth endpoint
+  This function is called attached to the scheduler
+  """
+  config = frappe.conf.get("huawei_push_kit_config")
+  if not config or not config.get('client_id') or not config.get('client_secret'):
+    return
+
+  if is_auth_token_valid(check_redis_cache_for_huawei_auth_token(),
+                         margin=HPK_AUTH_REFRESH_MARGIN):
+    return
+
+  _refresh_huawei_auth_token(config, wait=False)
+
+
+def is_auth_token_valid(auth, margin=0):
+  return bool(auth and auth.get("token") and
+              auth.get("expires_at", 0) - margin > time.time())
+
+
+def _refresh_huawei_auth_token(config, wait=False):
+  """
+  Single flight: only the worker holding the lock calls the OAuth endpoint,
+  the others wait for its token when wait is set
+  """
+  lock_key = frappe.cache().make_key(HPK_AUTH_LOCK_KEY)
+  pipe = frappe.cache().pipeline()
+  pipe.set(lock_key, 1, nx=True, ex=HPK_AUTH_LOCK_TIMEOUT)
+  if pipe.execute()[0]:
+    try:
+      return _fetch_huawei_auth_token(config)
+    finally:
+      pipe.delete(lock_key)
+      pipe.execute()
+
+  if not wait:
+    return
+
+  for i in range(HPK_AUTH_LOCK_TIMEOUT * 2):
+    time.sleep(0.5)
+    auth = check_redis_cache_for_huawei_auth_token()
+    if is_auth_token_valid(auth):
+      _auth_tokens[frappe.local.site] = auth
+      return auth.token
+
+
+def _fetch_huawei_auth_token(config):
   url = "https://oauth-login.cloud.huawei.com/oauth2/v3/token"
   headers = {"Content-Type": "application/x-www-form-urlencoded",
              "Accept": "application/json"}
@@ -219,10 +389,13 @@ def get_huawei_auth_token(config):
 
 
 def check_redis_cache_for_huawei_auth_token():
+  """
+  Returns frappe._dict(token, expires_at)
+  """
   user = get_default_values_for_redis_key().user
   key = get_default_values_for_redis_key().key
   val = frappe.cache().get_value(key, user=user, expires=True)
-  return val
+  return frappe._dict(val) if isinstance(val, dict) else None
 
 
 def get_default_values_for_redis_key():
@@ -232,61 +405,43 @@ def get_default_values_for_redis_key():
 def set_redis_cache_huawei_auth_token(auth_token: str, expires_in_sec):
   user = get_default_values_for_redis_key().user
   key = get_default_values_for_redis_key().key
-  frappe.cache().set_value(key, auth_token, user=user,
+  auth = frappe._dict(token=auth_token,
+                      expires_at=time.time() + expires_in_sec - 10)
+  frappe.cache().set_value(key, auth, user=user,
                            expires_in_sec=expires_in_sec - 10)
+  _auth_tokens[frappe.local.site] = auth
 
 
 def huawei_push_kit_error_handler(tokens=None, topic=None, title=None,
-                                  exc=None, body=None, data=None,
-                                  recipient_count=1, request_params=None):
-  # {
-  #   "code": "80000000",
-  #   "msg": "Success",
-  #   "requestId": "157440955549500001002006"
-  # }
-  status_code = frappe.flags.integration_request.status_code
-  response = None
-  try:
-    response = frappe.parse_json(frappe.flags.integration_request.json())
-  except Exception as e:
-    pass
-  huawei_error_code = response.get('error') if isinstance(response,
-                                                          dict) else ''
-  sub_error = response.get('sub_error') if isinstance(response, dict) else ''
-  error_description = response.get('error_description') if isinstance(response,
-                                                                      dict) else ''
-  success_count = 0
-  failure_count = 0
-  if isinstance(response, dict) and response.get('code') == '80000000':
-    success_count = recipient_count
-  elif isinstance(response, dict) and response.get('code') == '80100000':
-    msg = frappe.parse_json(response.get('msg'))
-    success_count = msg.get('success', 0)
-    failure_count = msg.get('failure', 0)
-    delete_huawei_invalid_tokens(
-      frappe.parse_json(msg.get("illegal_tokens", "")))
-  preMessage = "Tokens: {}\nTopic: {}\nTitle: {}\nBody: {}\nData: {}\nSuccess/Recipients: {}/{} \nFailure:{}".format(
-    tokens, topic, title, body, data, success_count, recipient_count,
-    failure_count)
-  if response and response.get('code') == '80000000':
+                                  body=None, data=None, recipient_count=1,
+                                  response=None):
+  """
+  Logs all the failed messages of a send in a single Error Log
+  """
+  if not response or not len(response.errors):
     return
-  code = response.get('code') if isinstance(response, dict) else ''
-  message = response.get('msg') if isinstance(response, dict) else ''
-  print(
-    "- EXC\nCode: {}\nMessage: {}".format(code, message))
+
+  preMessage = "Tokens: {}\nTopic: {}\nTitle: {}\nBody: {}\nData: {}\nSuccess/Recipients: {}/{} \nFailure:{}".format(
+    len(tokens or []), topic, title, body, data, response.success_count,
+    recipient_count, response.failure_count)
+  excs = []
+  for e in response.errors:
+    r = e.response if isinstance(e.response, dict) else {}
+    excs.append(
+      "- EXC: {}\nCode: {}\nMessage: {}\nStatus Code: {}\nHuawei Error Code: {}\nSub Error: {}\nError Description: {}\nTokens: {}".format(
+        str(e.exc),
+        r.get('code', ''),
+        r.get('msg', ''),
+        e.status_code,
+        r.get('error', ''),
+        r.get('sub_error', ''),
+        r.get('error_description', ''),
+        e.tokens
+      ))
+  print("\n".join(excs))
   frappe.log_error(
     title="Huawei Push Kit Error",
-    message="{}\nEXC: {}\nCode: {}\nMessage: {}\nStatus Code: {}\nHuawei Error Code: {}\nSub Error: {}\nError Description: {}\n Request Params: {}".format(
-      preMessage,
-      str(exc),
-      code,
-      message,
-      status_code,
-      huawei_error_code,
-      sub_error,
-      error_description,
-      request_params
-    ))
+    message="{}\n{}".format(preMessage, "\n".join(excs)))
 
 
 def notify_via_hpk(title, body, data=None, roles=None, users=None, topics=None,
@@ -301,10 +456,6 @@ def notify_via_hpk(title, body, data=None, roles=None, users=None, topics=None,
 def _notify_via_hpk(title, body, data=None, roles=None, users=None,
                     topics=None, tokens=None,
                     custom_android_configuration=None):
-  users = set(users or [])
-  if roles:
-    users.union(set([x.parent for x in frappe.db.get_all("Has Role", fields=[
-      "distinct parent"], filters={"role": ["IN", roles or []]})]))
   if data == None:
     data = frappe._dict()
 
@@ -313,15 +464,21 @@ def _notify_via_hpk(title, body, data=None, roles=None, users=None,
   else:
     data = frappe._dict(data)
 
-  for user in users:
-    send_huawei_notification_to_user(user, title=title, body=body, data=data,
-                                     custom_android_configuration=custom_android_configuration)
+  notification_log = NotificationLog()
+  if users or roles:
+    r = resolve_tokens("Huawei User Token", users=users, roles=roles)
+    send_huawei_notification_to_users(
+      r.user_tokens, title=title, body=body, data=data,
+      custom_android_configuration=custom_android_configuration,
+      notification_log=notification_log)
 
   topics = set(topics or [])
   for topic in topics:
     send_huawei_notification_to_topic(topic=topic, title=title, body=body,
-                                      data=data,
-                                      custom_android_configuration=custom_android_configuration)
+                                      data=frappe._dict(data),
+                                      custom_android_configuration=custom_android_configuration,
+                                      notification_log=notification_log)
+  notification_log.flush()
 
   tokens = set(tokens or [])
   if len(tokens):
@@ -1,5 +1,6 @@
 import ast
 import json
+import time
 
 import frappe
 import six
@@ -9,6 +10,7 @@ from frappe.utils import strip_html_tags, strip_html, cint
 
 from .fcm import notify_via_fcm
 from .hpk import notify_via_hpk
+from .recipients import get_role_users, get_user_contacts
 from .sms_setting import get_sms_recipients_for_notification, send_sms
 
 """
@@ -18,8 +20,85 @@ So that FCM can be a new channel
 """
 
 
+NOTIFICATION_INTENTS_KEY = "notification_intents"
+# Triggers of the same Notification and document within this many seconds are sent once,
+# override with notification_coalesce_window in site_config
+# Intents are sent by the drain on the next scheduler tick after they are due
+NOTIFICATION_COALESCE_WINDOW = 5
+
+
 def send_notification(self, doc):
   '''Build recipients and send Notification'''
+  if cint(self.get("send_in_background")) and not frappe.flags.in_test:
+    # Only the intent is recorded once the document is committed, the drain renders and sends
+    frappe.enqueue("renovation_core.utils.notification.add_notification_intent", queue="short",
+                   enqueue_after_commit=True, notification=self.name, doctype=doc.doctype, name=doc.name)
+    return
+
+  _send_notification(self, doc)
+
+
+def add_notification_intent(notification, doctype, name):
+  """
+  Records the intent in the sorted set notification_intents, scored by the time it is due
+  The triggers recorded before it is due keep the first due time, so they are sent once
+
+  Returns True if the intent is new
+  """
+  window = cint(frappe.conf.get("notification_coalesce_window")) or NOTIFICATION_COALESCE_WINDOW
+  pipe = frappe.cache().pipeline()
+  pipe.zadd(_get_intents_key(), {json.dumps([notification, doctype, name]): time.time() + window}, nx=True)
+  return bool(pipe.execute()[0])
+
+
+def drain_notification_intents():
+  """
+  Sends the intents that are due, with the latest document
+  Every intent is claimed by removing it from the set, so that concurrent drains send it once
+
+  This function is called attached to the scheduler to be invoked every minute
+  """
+  key = _get_intents_key()
+  pipe = frappe.cache().pipeline()
+  pipe.zrangebyscore(key, "-inf", time.time())
+  intents = pipe.execute()[0]
+  if not len(intents):
+    return
+
+  for intent in intents:
+    pipe.zrem(key, intent)
+  for intent, claimed in zip(intents, pipe.execute()):
+    if not claimed:
+      continue
+    notification, doctype, name = json.loads(frappe.safe_decode(intent))
+    try:
+      process_notification_intent(notification, doctype, name)
+    except Exception:
+      frappe.log_error(title="Notification Intent Error", message="{}: {} {}\n{}".format(
+          notification, doctype, name, frappe.get_traceback()))
+
+
+def process_notification_intent(notification, doctype, name):
+  """
+  The condition of the Notification is checked again against the latest document
+  """
+  if not frappe.db.exists("Notification", notification) or not frappe.db.exists(doctype, name):
+    return
+
+  alert = frappe.get_doc("Notification", notification)
+  doc = frappe.get_doc(doctype, name)
+  if not alert.enabled or \
+          (alert.condition and not frappe.safe_eval(alert.condition, None, get_context(doc))):
+    return
+
+  _send_notification(alert, doc)
+
+
+def _get_intents_key():
+  return frappe.cache().make_key(NOTIFICATION_INTENTS_KEY)
+
+
+def _send_notification(self, doc):
 
   context = get_context(doc)
   context = {"doc": doc, "alert": self, "comments": None, "frappe": frappe}
@@ -75,15 +154,18 @@ def send_via_fcm(notification, doc, context):
   recipients = get_fcm_recipients(notification, context)
 
   if recipients.users and len(recipients.users):
-    for user in recipients.users:
-      lang = frappe.get_cached_value('User', user, 'language')
+    system_lang = frappe.get_cached_value(
+        'System Settings', 'System Settings', 'language')
+    # Render once per language and send to all the users of that language in one job
+    for lang, users in get_users_by_language(recipients.users).items():
+      _data = data
       if isinstance(data, dict):
-        data['lang'] = lang
+        _data = dict(data, lang=lang)
       if isinstance(context, dict):
         context['lang'] = lang
       _body = body
       _title = title
-      if notification and lang and frappe.get_cached_value('System Settings', 'System Settings', 'language') != lang:
+      if notification and lang and system_lang != lang:
         find_row = notification.get(
             'language_wise_content', {'language': lang})
         if find_row:
@@ -96,9 +178,9 @@ def send_via_fcm(notification, doc, context):
         else:
           _title = _(title, lang)
           _body = _(body, lang)
-      notify_via_fcm(title=_title, body=_body, data=data, users=[user])
+      notify_via_fcm(title=_title, body=_body, data=_data, users=users)
       if cint(notification.get('send_via_hpk')):
-        notify_via_hpk(title=_title, body=_body, data=data, users=[user],
+        notify_via_hpk(title=_title, body=_body, data=_data, users=users,
                        custom_android_configuration=custom_android_configuration)
 
   if recipients.topics and len(recipients.topics):
@@ -131,8 +213,7 @@ def get_fcm_recipients(notification, context):
     if target_type == "User" and target_user:
       users.append(target_user)
     elif target_type == "Role" and target_role:
-      users.extend([x.parent for x in frappe.get_all(
-          "Has Role", ["parent"], {"parenttype": "User", "role": target_role})])
+      users.extend(get_role_users([target_role]))
     elif target_type == "Role Profile":
       frappe.throw("Not implemented")
     elif target_type == "Topic" and r.get("topic", None):
@@ -166,3 +247,16 @@ def get_fcm_recipients(notification, context):
       "topics": topics,
       "tokens": tokens
   })
+
+
+def get_users_by_language(users):
+  """
+  Groups the users by their language from the recipients cache
+  Returns { language: [users] }
+  """
+  contacts = get_user_contacts(users)
+  languages = {}
+  for user in users:
+    languages.setdefault(contacts[user].language if user in contacts else None, []).append(user)
+
+  return languages
@@ -0,0 +1,155 @@
+import json
+
+import frappe
+from frappe.utils import cint
+
+from .device_tokens import QUERY_CHUNK_SIZE, get_chunks
+
+"""
+Recipients Cache
+Shared by all the notification channels to resolve Role and User recipients without a query per send
+
+  role_users: { role: [users] }
+  user_contacts: { user: { enabled, email, mobile_no, phone, language } }
+
+Entries are invalidated when a User or a Role changes
+"""
+
+ROLE_USERS_KEY = "role_users"
+USER_CONTACTS_KEY = "user_contacts"
+USER_CONTACT_FIELDS = ("enabled", "email", "mobile_no", "phone", "language")
+
+
+def get_role_users(roles):
+  """
+  Returns the distinct users of the roles
+  """
+  roles = list(set(roles or []))
+  if not len(roles):
+    return []
+
+  key = _get_key(ROLE_USERS_KEY)
+  pipe = frappe.cache().pipeline()
+  pipe.hmget(key, roles)
+  role_users = {role: json.loads(frappe.safe_decode(users)) if users is not None else None
+                for role, users in zip(roles, pipe.execute()[0])}
+  missing = [x for x, users in role_users.items() if users is None]
+  if len(missing):
+    fetched = {x: [] for x in missing}
+    for parent, role in frappe.db.sql("""
+      SELECT DISTINCT parent, role FROM `tabHas Role`
+      WHERE parenttype = 'User' AND role IN %(roles)s
+    """, {"roles": tuple(missing)}):
+      fetched[role].append(parent)
+    for role, users in fetched.items():
+      pipe.hset(key, role, json.dumps(users))
+    pipe.execute()
+    role_users.update(fetched)
+
+  users = []
+  seen = set()
+  for role in roles:
+    for user in role_users[role]:
+      if user not in seen:
+        seen.add(user)
+        users.append(user)
+  return users
+
+
+def get_user_contacts(users):
+  """
+  Returns { user: { enabled, email, mobile_no, phone, language } } of the existing users
+  """
+  users = list(set(users or []))
+  contacts = frappe._dict()
+  if not len(users):
+    return contacts
+
+  key = _get_key(USER_CONTACTS_KEY)
+  pipe = frappe.cache().pipeline()
+  missing = []
+  for _users in get_chunks(users, QUERY_CHUNK_SIZE):
+    pipe.hmget(key, _users)
+    for user, contact in zip(_users, pipe.execute()[0]):
+      if contact is None:
+        missing.append(user)
+      else:
+        contact = json.loads(frappe.safe_decode(contact))
+        if contact:
+          contacts[user] = frappe._dict(contact)
+
+  for _users in get_chunks(missing, QUERY_CHUNK_SIZE):
+    fetched = {x.name: frappe._dict({f: x.get(f) for f in USER_CONTACT_FIELDS})
+               for x in frappe.get_all("User", filters={"name": ["in", _users]},
+                                       fields=["name"] + list(USER_CONTACT_FIELDS))}
+    for user in _users:
+      # users that do not exist are cached too, as empty contacts
+      pipe.hset(key, user, json.dumps(fetched.get(user) or {}))
+    pipe.execute()
+    contacts.update(fetched)
+
+  return contacts
+
+
+def get_user_mobile_nos(users, enabled_only=False):
+  """
+  Returns the mobile_no, or else the phone, of the users that have one
+  """
+  mobile_nos = []
+  for user, contact in get_user_contacts(users).items():
+    if enabled_only and not cint(contact.enabled):
+      continue
+    if contact.mobile_no or contact.phone:
+      mobile_nos.append(contact.mobile_no or contact.phone)
+  return mobile_nos
+
+
+def clear_role_users(roles=None):
+  _clear(ROLE_USERS_KEY, roles)
+
+
+def clear_user_contacts(users=None):
+  _clear(USER_CONTACTS_KEY, users)
+
+
+def _clear(name, fields=None):
+  if fields is not None and not len(fields):
+    return
+
+  pipe = frappe.cache().pipeline()
+  if fields is None:
+    pipe.delete(_get_key(name))
+  else:
+    pipe.hdel(_get_key(name), *set(fields))
+  pipe.execute()
+
+
+def clear_recipients_cache():
+  clear_role_users()
+  clear_user_contacts()
+
+
+def on_user_change(doc, method=None):
+  """
+  Invalidates the contacts of the user and the users of the roles added or removed
+  """
+  clear_user_contacts([doc.name])
+
+  before = doc.get_doc_before_save() if method != "on_trash" else None
+  old_roles = set(x.role for x in before.get("roles") or []) if before else set()
+  new_roles = set(x.role for x in doc.get("roles") or [])
+  if method == "on_trash" or not before:
+    clear_role_users(old_roles | new_roles)
+  else:
+    clear_role_users(old_roles ^ new_roles)
+
+
+def on_role_change(doc, method=None):
+  """
+  Disabling or deleting a Role removes its Has Role rows without saving the Users
+  """
+  clear_role_users([doc.name])
+
+
+def _get_key(name):
+  return frappe.cache().make_key(name)
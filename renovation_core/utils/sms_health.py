@@ -0,0 +1,107 @@
+import time
+
+import frappe
+from frappe.utils import cint, flt
+
+"""
+SMS Provider Health
+The outcome and latency of every gateway request are counted in per-minute windows in redis
+  sms_provider_health|{provider}|{window}: { requests, errors, latency }
+
+When the error rate of the recent windows is too high, the circuit of the provider is opened
+and the router fails over to the next eligible provider until it closes again
+  sms_provider_circuit|{provider}: set while the circuit is open
+
+Providers slower than SMS_SLOW_LATENCY on average are tried after the others
+"""
+
+SMS_HEALTH_KEY = "sms_provider_health"
+SMS_CIRCUIT_KEY = "sms_provider_circuit"
+# Seconds per health window, and the number of recent windows considered
+SMS_HEALTH_WINDOW = 60
+SMS_HEALTH_WINDOWS = 5
+# The circuit opens when at least this many requests in the recent windows
+# failed at this rate or more
+SMS_CIRCUIT_MIN_REQUESTS = 10
+SMS_CIRCUIT_ERROR_RATE = 0.5
+# Seconds the circuit stays open before the provider is tried again
+SMS_CIRCUIT_OPEN_TIME = 60
+# Average seconds per request above which a provider is tried last
+SMS_SLOW_LATENCY = 5
+
+
+def record_requests(provider, results):
+  """
+  :param results: [(ok, elapsed seconds)] of the requests made to the provider
+  """
+  if not len(results):
+    return
+
+  key = _get_health_key(provider, _get_window())
+  pipe = frappe.cache().pipeline()
+  pipe.hincrby(key, "requests", len(results))
+  pipe.hincrby(key, "errors", len([x for x in results if not x[0]]))
+  pipe.hincrbyfloat(key, "latency", sum(flt(x[1]) for x in results))
+  pipe.expire(key, SMS_HEALTH_WINDOW * (SMS_HEALTH_WINDOWS + 1))
+  pipe.execute()
+
+  health = get_providers_health([provider])[provider]
+  if health.requests >= SMS_CIRCUIT_MIN_REQUESTS and \
+          health.errors >= health.requests * SMS_CIRCUIT_ERROR_RATE:
+    open_circuit(provider)
+
+
+def open_circuit(provider):
+  """
+  The health windows are reset so that the provider starts afresh when the circuit closes
+  """
+  window = _get_window()
+  pipe = frappe.cache().pipeline()
+  pipe.set(_get_circuit_key(provider), 1, ex=SMS_CIRCUIT_OPEN_TIME)
+  for i in range(SMS_HEALTH_WINDOWS):
+    pipe.delete(_get_health_key(provider, window - i))
+  pipe.execute()
+  frappe.log_error(title="SMS Provider Circuit Open",
+                   message="SMS Provider {} is skipped for {} seconds".format(provider, SMS_CIRCUIT_OPEN_TIME))
+
+
+def get_providers_health(providers):
+  """
+  Returns { provider: { requests, errors, latency, is_open, is_slow } } over the recent windows
+  """
+  providers = list(set(providers or []))
+  window = _get_window()
+  pipe = frappe.cache().pipeline()
+  for provider in providers:
+    pipe.exists(_get_circuit_key(provider))
+    for i in range(SMS_HEALTH_WINDOWS):
+      pipe.hgetall(_get_health_key(provider, window - i))
+  results = pipe.execute()
+
+  health = frappe._dict()
+  step = SMS_HEALTH_WINDOWS + 1
+  for i, provider in enumerate(providers):
+    is_open = results[i * step]
+    h = frappe._dict(requests=0, errors=0, latency=0.0, is_open=bool(is_open))
+    for w in results[i * step + 1:(i + 1) * step]:
+      w = {frappe.safe_decode(k): v for k, v in (w or {}).items()}
+      h.requests += cint(w.get("requests"))
+      h.errors += cint(w.get("errors"))
+      h.latency += flt(w.get("latency"))
+    h.latency = h.latency / h.requests if h.requests else 0.0
+    h.is_slow = h.latency > SMS_SLOW_LATENCY
+    health[provider] = h
+
+  return health
+
+
+def _get_window():
+  return int(time.time() // SMS_HEALTH_WINDOW)
+
+
+def _get_health_key(provider, window):
+  return frappe.cache().make_key("{}|{}|{}".format(SMS_HEALTH_KEY, provider, window))
+
+
+def _get_circuit_key(provider):
+  return frappe.cache().make_key("{}|{}".format(SMS_CIRCUIT_KEY, provider))
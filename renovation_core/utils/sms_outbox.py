@@ -0,0 +1,300 @@
+import json
+import time
+
+import frappe
+from frappe.model.naming import make_autoname
+from frappe.utils import cint, flt, now
+
+from .sms_health import get_providers_health
+from .sms_setting import _get_gateway_args, _get_gateway_request, _get_sent_receivers, \
+    encode_receivers, get_receiver_batches, route_receivers, safe_decode, send_gateway_requests
+
+"""
+SMS Outbox
+send_sms(..., queue=True) routes the receivers and pushes them into the outbox of their SMS Provider,
+returning a handle right away. Workers drain the outboxes at the Rate Limit of each provider.
+
+  sms_outbox|{provider}: list of { handle, receivers }, one item per gateway request
+  sms_outbox_job|{handle}: { message, providers, total, sent, failed }
+  sms_outbox_rate|{provider}: token bucket { tokens, ts }
+  sms_outbox_lock|{provider}: held by the worker draining the outbox
+
+Items of a provider whose circuit is open are moved to the outboxes of the next eligible providers,
+or wait in the outbox when there is none
+
+Items are popped before they are sent, so a worker dying mid-send loses its items instead of sending them twice
+"""
+
+SMS_OUTBOX_KEY = "sms_outbox"
+SMS_OUTBOX_JOB_KEY = "sms_outbox_job"
+SMS_OUTBOX_RATE_KEY = "sms_outbox_rate"
+SMS_OUTBOX_LOCK_KEY = "sms_outbox_lock"
+# Status of the jobs can be polled for this many seconds
+SMS_OUTBOX_JOB_EXPIRY = 7 * 24 * 60 * 60
+# Max gateway requests popped from an outbox at once
+SMS_OUTBOX_CHUNK_SIZE = 100
+# A worker drains for at most this many seconds and enqueues another drain for the rest
+SMS_OUTBOX_DRAIN_TIME = 4 * 60
+SMS_OUTBOX_LOCK_TIMEOUT = SMS_OUTBOX_DRAIN_TIME + 60
+
+# Takes up to ARGV[4] tokens from the bucket, refilled at ARGV[1] tokens per second up to ARGV[2]
+# Returns the number of tokens taken
+_TAKE_TOKENS = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local ts = tonumber(ARGV[3])
+local state = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local last_ts = tonumber(state[2]) or ts
+tokens = math.min(burst, tokens + math.max(ts - last_ts, 0) * rate)
+local taken = math.min(tonumber(ARGV[4]), math.floor(tokens))
+redis.call('hmset', KEYS[1], 'tokens', tostring(tokens - taken), 'ts', ARGV[3])
+redis.call('expire', KEYS[1], 3600)
+return taken
+"""
+
+
+def enqueue_sms(receiver_list, message, providers):
+  """
+  Pushes the receivers into the outboxes of their SMS Providers
+  Receivers without an allowed provider are counted as failed
+
+  Returns the handle to poll get_sms_outbox_status with
+  """
+  handle = make_autoname("hash", "SMS Log")
+  provider_wise_receivers, error_message = route_receivers(receiver_list, providers)
+
+  pipe = frappe.cache().pipeline()
+  job_key = _get_job_key(handle)
+  pipe.hset(job_key, "message", safe_decode(message))
+  pipe.hset(job_key, "providers", json.dumps(
+      [{"provider": x.get("provider"), "code": x.get("code")} for x in providers]))
+  pipe.hset(job_key, "total", len(receiver_list))
+  pipe.hset(job_key, "sent", 0)
+  pipe.hset(job_key, "failed", len(error_message))
+  pipe.expire(job_key, SMS_OUTBOX_JOB_EXPIRY)
+  for provider, receivers in provider_wise_receivers.items():
+    ss = frappe.get_cached_doc("SMS Provider", provider)
+    pipe.rpush(_get_outbox_key(provider), *[
+        json.dumps({"handle": handle, "receivers": batch}) for batch in get_receiver_batches(ss, receivers)])
+  pipe.execute()
+
+  for provider in provider_wise_receivers:
+    enqueue_drain(provider)
+
+  return handle
+
+
+@frappe.whitelist()
+def get_sms_outbox_status(handle):
+  pipe = frappe.cache().pipeline()
+  pipe.hgetall(_get_job_key(handle))
+  job = {frappe.safe_decode(k): v for k, v in (pipe.execute()[0] or {}).items()}
+  if not job:
+    frappe.throw("SMS Outbox job not found")
+
+  status = frappe._dict(handle=handle, total=cint(job.get("total")),
+                        sent=cint(job.get("sent")), failed=cint(job.get("failed")))
+  status.pending = max(status.total - status.sent - status.failed, 0)
+  status.status = "Completed" if not status.pending else (
+      "Sending" if status.sent or status.failed else "Queued")
+  return status
+
+
+def enqueue_drain(provider):
+  frappe.enqueue("renovation_core.utils.sms_outbox.drain_sms_outbox",
+                 queue="long", provider=provider)
+
+
+def drain_pending_outboxes():
+  """
+  Enqueues a drain for every outbox that still has items,
+  in case a worker stopped before it could enqueue the next drain
+
+  This function is called attached to the scheduler to be invoked every few minutes
+  """
+  pipe = frappe.cache().pipeline()
+  providers = [x.name for x in frappe.get_all("SMS Provider")]
+  for provider in providers:
+    pipe.llen(_get_outbox_key(provider))
+  for provider, pending in zip(providers, pipe.execute()):
+    if pending:
+      enqueue_drain(provider)
+
+
+def drain_sms_outbox(provider):
+  """
+  Sends the items of the outbox of the provider at its Rate Limit
+  Only one worker drains an outbox at a time
+  """
+  pipe = frappe.cache().pipeline()
+  lock_key = frappe.cache().make_key("{}|{}".format(SMS_OUTBOX_LOCK_KEY, provider))
+  pipe.set(lock_key, 1, nx=True, ex=SMS_OUTBOX_LOCK_TIMEOUT)
+  if not pipe.execute()[0]:
+    return
+
+  log = SMSOutboxLog(provider)
+  try:
+    ss = frappe.get_cached_doc("SMS Provider", provider)
+    outbox_key = _get_outbox_key(provider)
+    started = time.time()
+    while time.time() - started < SMS_OUTBOX_DRAIN_TIME:
+      limit = take_tokens(ss, SMS_OUTBOX_CHUNK_SIZE)
+      if not limit:
+        time.sleep(1.0 / flt(ss.rate_limit))
+        continue
+
+      pipe.lrange(outbox_key, 0, limit - 1)
+      pipe.ltrim(outbox_key, limit, -1)
+      items = [json.loads(x) for x in pipe.execute()[0]]
+      if not len(items):
+        break
+
+      if get_providers_health([provider])[provider].is_open:
+        waiting = reroute_outbox_items(provider, items)
+        if len(waiting):
+          pipe.rpush(outbox_key, *[json.dumps(x) for x in waiting])
+          pipe.execute()
+          # left for drain_pending_outboxes to pick up once the circuit closes
+          return
+        continue
+
+      send_outbox_items(ss, items, log)
+  finally:
+    log.flush()
+    pipe.delete(lock_key)
+    pipe.execute()
+
+  pipe.llen(_get_outbox_key(provider))
+  if pipe.execute()[0]:
+    enqueue_drain(provider)
+
+
+def send_outbox_items(ss, items, log):
+  jobs = get_jobs(set(x["handle"] for x in items))
+  items = [x for x in items if x["handle"] in jobs]
+  gateway_requests = [_get_gateway_request(ss, _get_gateway_args(ss, jobs[x["handle"]].message),
+                                           encode_receivers(ss, x["receivers"])) for x in items]
+  responses = send_gateway_requests(ss, gateway_requests)
+
+  pipe = frappe.cache().pipeline()
+  for item, response in zip(items, responses):
+    receivers = item["receivers"]
+    sent_to = [] if isinstance(response, Exception) else _get_sent_receivers(ss, receivers, response)
+    job_key = _get_job_key(item["handle"])
+    pipe.hincrby(job_key, "sent", len(sent_to))
+    pipe.hincrby(job_key, "failed", len(receivers) - len(sent_to))
+    log.add(item["handle"], jobs[item["handle"]].message, receivers, sent_to)
+  pipe.execute()
+
+
+def reroute_outbox_items(provider, items):
+  """
+  Moves the receivers of the items to the outboxes of the next eligible providers of their jobs
+
+  Returns the items that have no other provider to go to
+  """
+  jobs = get_jobs(set(x["handle"] for x in items))
+  waiting = []
+  rerouted = set()
+  pipe = frappe.cache().pipeline()
+  for item in items:
+    job = jobs.get(item["handle"])
+    if not job:
+      continue
+
+    receivers = item["receivers"]
+    provider_wise_receivers, errors = route_receivers(
+        receivers, job.providers, tried={d: {provider} for d in receivers}, probe_open=False)
+    for p, _receivers in provider_wise_receivers.items():
+      ss = frappe.get_cached_doc("SMS Provider", p)
+      pipe.rpush(_get_outbox_key(p), *[
+          json.dumps({"handle": item["handle"], "receivers": batch}) for batch in get_receiver_batches(ss, _receivers)])
+      rerouted.add(p)
+
+    routed = set(d for _receivers in provider_wise_receivers.values() for d in _receivers)
+    if len(routed) < len(receivers):
+      waiting.append(dict(item, receivers=[d for d in receivers if d not in routed]))
+  pipe.execute()
+
+  for p in rerouted:
+    enqueue_drain(p)
+
+  return waiting
+
+
+def get_jobs(handles):
+  """
+  Returns { handle: { message, providers } } of the jobs that have not expired
+  """
+  handles = list(handles)
+  pipe = frappe.cache().pipeline()
+  for handle in handles:
+    pipe.hmget(_get_job_key(handle), "message", "providers")
+
+  jobs = frappe._dict()
+  for handle, (message, providers) in zip(handles, pipe.execute()):
+    if message is None:
+      continue
+    jobs[handle] = frappe._dict(message=frappe.safe_decode(message),
+                                providers=json.loads(providers or "[]"))
+  return jobs
+
+
+def take_tokens(ss, count):
+  """
+  Takes up to count tokens from the bucket of the SMS Provider, one per gateway request
+  Providers without a Rate Limit are not limited
+  """
+  rate = flt(ss.get("rate_limit"))
+  if rate <= 0:
+    return count
+
+  burst = max(cint(ss.get("rate_limit_burst")), 1)
+  pipe = frappe.cache().pipeline()
+  pipe.eval(_TAKE_TOKENS, 1, frappe.cache().make_key("{}|{}".format(SMS_OUTBOX_RATE_KEY, ss.name)),
+            rate, burst, time.time(), count)
+  return cint(pipe.execute()[0])
+
+
+class SMSOutboxLog(object):
+  """
+  Collects the results of a drain per job and writes one SMS Log per job with a multi-row insert
+  """
+
+  def __init__(self, provider):
+    self.provider = provider
+    self.jobs = frappe._dict()
+
+  def add(self, handle, message, requested, sent_to):
+    job = self.jobs.setdefault(handle, frappe._dict(
+        message=message, requested=[], sent_to=[]))
+    job.requested.extend(requested)
+    job.sent_to.extend(sent_to)
+
+  def flush(self):
+    if not len(self.jobs):
+      return
+
+    fields = ["name", "creation", "modified", "owner", "modified_by", "docstatus",
+              "sent_on", "provider", "message", "no_of_requested_sms", "requested_numbers",
+              "no_of_sent_sms", "sent_to"]
+    ts = now()
+    values = []
+    for job in self.jobs.values():
+      values.append((
+          make_autoname("hash", "SMS Log"), ts, ts, frappe.session.user, frappe.session.user, 1,
+          ts, self.provider, job.message, len(job.requested), "\n".join(job.requested),
+          len(job.sent_to), "\n".join(job.sent_to)
+      ))
+    frappe.db.bulk_insert("SMS Log", fields=fields, values=values)
+    frappe.db.commit()
+    self.jobs = frappe._dict()
+
+
+def _get_outbox_key(provider):
+  return frappe.cache().make_key("{}|{}".format(SMS_OUTBOX_KEY, provider))
+
+
+def _get_job_key(handle):
+  return frappe.cache().make_key("{}|{}".format(SMS_OUTBOX_JOB_KEY, handle))
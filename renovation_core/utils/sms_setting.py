@@ -1,28 +1,61 @@
 import ast
+import json
 import re
+import time
+from functools import lru_cache
 from typing import Callable
 
 import frappe
 from frappe import throw, _
 from frappe.core.doctype.sms_settings.sms_settings import get_headers
-from frappe.utils import now_datetime, nowtime, get_time
+from frappe.utils import cint, cstr, now_datetime, nowtime, get_time
 from phonenumbers import parse as parse_phone_number
-from phonenumbers.phonenumberutil import region_code_for_country_code
+from phonenumbers.phonenumberutil import UNKNOWN_REGION, region_code_for_country_code
 from requests import Response
 from six import string_types
 
+from .device_tokens import get_chunks
+from .recipients import get_role_users, get_user_mobile_nos
+from .sms_health import get_providers_health, record_requests
+
+# Characters removed from mobile numbers
+RECEIVER_NO_TRANSLATION = str.maketrans("", "", " -()")
+RECEIVER_NO_PATTERN = re.compile(r"^\+?[0-9]+$")
+
+# Default number of requests sent in parallel to a single SMS Provider,
+# override with sms_max_workers in site_config
+SMS_MAX_WORKERS = 8
+# Seconds to wait for a gateway to accept the connection and to respond,
+# override the latter with sms_timeout in site_config
+SMS_CONNECT_TIMEOUT = 5
+SMS_TIMEOUT = 30
+# Compiled routing tables per provider configuration
+#   sms_routing_table: { config hash: routing table }
+SMS_ROUTING_TABLE_KEY = "sms_routing_table"
+# Keep-alive sessions per site and SMS Provider: { (site, provider): requests.Session }
+_sessions = {}
+
 
 def validate_receiver_nos(receiver_list):
-  plus = frappe.db.get_value('SMS Settings', None, 'start_with_plus')
+  """
+  Normalizes the numbers in a single pass with RECEIVER_NO_TRANSLATION
+  and the start_with_plus of the cached SMS Settings
+  Numbers left with anything but digits are dropped, and so are the duplicates
+  """
+  plus = frappe.get_cached_doc('SMS Settings').get('start_with_plus')
   validated_receiver_list = []
-  for d in receiver_list:
-    # remove invalid character
-    for x in [' ', '-', '(', ')']:
-      d = d.replace(x, '')
-    if plus and plus == "Add" and d[0] != '+':
+  seen = set()
+  for d in receiver_list or []:
+    d = cstr(d).translate(RECEIVER_NO_TRANSLATION)
+    if not d:
+      continue
+    if plus == "Add" and d[0] != '+':
       d = '+' + d
-    elif plus and plus == "Remove" and d[0] == '+':
+    elif plus == "Remove" and d[0] == '+':
       d = d[1:]
+    if d in seen or not RECEIVER_NO_PATTERN.match(d):
+      continue
+    seen.add(d)
     validated_receiver_list.append(d)
 
   if not validated_receiver_list:
@@ -32,8 +65,11 @@ def validate_receiver_nos(receiver_list):
 
 @frappe.whitelist()
 def send_sms(receiver_list, msg, sender_name='', success_msg=True, provider=None,
-             is_sms_sent: Callable[[Response, dict], bool] = None):
-  import json
+             is_sms_sent: Callable[[Response, dict], bool] = None, queue=False):
+  """
+  With queue set, the receivers are pushed into the SMS Outbox instead of being sent right away
+  and the handle of the outbox job is returned, is_sms_sent is not supported then
+  """
   if isinstance(receiver_list, string_types):
     receiver_list = json.loads(receiver_list)
     if not isinstance(receiver_list, list):
@@ -56,7 +92,10 @@ def send_sms(receiver_list, msg, sender_name='', success_msg=True, provider=None
   else:
     providers = provider
 
-  if providers:
+  if providers and cint(queue):
+    from .sms_outbox import enqueue_sms
+    return enqueue_sms(receiver_list, arg['message'], providers=providers)
+  elif providers:
     return send_via_gateway(arg, providers=providers, is_sms_sent=is_sms_sent)
   else:
     frappe.throw(_("Please Update SMS Settings"))
@@ -70,95 +109,306 @@ def get_default_sms_providers():
 
 
 def send_via_gateway(arg, providers, is_sms_sent: Callable[[Response, dict], bool] = None):
-  code_wise_provider, provider_wise_time = _get_provider_validate_data(providers)
+  """
+  Receivers are grouped by their selected SMS Provider and sent to
+  concurrently over the keep-alive session of each provider
+  Receivers of requests that failed at the gateway fail over to the next eligible provider
+  """
   success_list = []
   error_message = []
   provider_wise_success_list = frappe._dict()
-  args = {}
-  for d in arg.get('receiver_list'):
-    country_code = _get_country_code(d)
-    if not (country_code in code_wise_provider or "all" in code_wise_provider):
-      error_message.append(_("Provider not found for {}").format(d))
-      continue
-    selected_provider = None
-    for p in code_wise_provider.get(country_code) or code_wise_provider.get("all"):
-      # Check Disabled
-      if not frappe.get_cached_value("SMS Provider", p, "enabled"):
-        continue
-      # Check Timing
-      allow_now = not provider_wise_time.get(p)
-      if provider_wise_time.get(p):
-        for t in provider_wise_time.get(p):
-          if get_time(t.from_time) <= get_time(nowtime()) <= get_time(t.to_time):
-            allow_now = True
-            break
-      if allow_now:
-        selected_provider = p
-        break
-    if not selected_provider:
-      error_message.append(
-          _("SMS Provider doesn't allow to send SMS now due to time restriction. For {}").format(d))
-    ss = frappe.get_cached_doc("SMS Provider", selected_provider)
-    headers = get_headers(ss)
-    args = {ss.message_parameter: re.sub(
-        r'\s+', ' ', safe_decode(arg.get('message')))}
-    for hp in ss.get("parameters"):
-      if not hp.header:
-        args[hp.parameter] = hp.value
-    args[ss.receiver_parameter] = d
-    url = ss.sms_gateway_url
-    if "%(" in url:
-      url = ss.sms_gateway_url % args
-    response = send_request(url, {} if "%(" in ss.sms_gateway_url else args,
-                          headers, ss.use_post, ss.get('request_as_json'),
-                          request_as_params=ss.request_as_params)
-    sms_sent = is_sms_sent(response, ss) if is_sms_sent else None
-    if (sms_sent is None and 200 <= response.status_code < 300) or sms_sent:
-      provider_wise_success_list.setdefault(selected_provider, []).append(d)
-      success_list.append(d)
+  # { receiver: providers already tried }
+  tried = frappe._dict()
+  receivers = arg.get('receiver_list')
+  while len(receivers):
+    provider_wise_receivers, errors = route_receivers(receivers, providers, tried=tried)
+    error_message.extend(errors)
+    receivers = []
+    for p, _receivers in provider_wise_receivers.items():
+      ss = frappe.get_cached_doc("SMS Provider", p)
+      args = _get_gateway_args(ss, arg.get('message'))
+      batches = get_receiver_batches(ss, _receivers)
+      gateway_requests = [_get_gateway_request(
+          ss, args, encode_receivers(ss, batch)) for batch in batches]
+      for batch, response in zip(batches, send_gateway_requests(ss, gateway_requests)):
+        for d in batch:
+          tried.setdefault(d, set()).add(p)
+        if is_gateway_error(response):
+          error_message.append(_("SMS Provider {} failed for {}: {}").format(
+              p, ", ".join(batch), response))
+          receivers.extend(batch)
+          continue
+        sent_to = _get_sent_receivers(ss, batch, response, is_sms_sent)
+        provider_wise_success_list.setdefault(p, []).extend(sent_to)
+        success_list.extend(sent_to)
   log_doc = []
   if len(success_list) > 0:
-    args.update(arg)
     if frappe.db.exists("DocType", "SMS Log"):
       for p, s_list in provider_wise_success_list.items():
-        log_doc.append(create_sms_log(args, s_list, provider=p))
+        log_doc.append(create_sms_log(arg, s_list, provider=p))
     if arg.get('success_msg'):
       frappe.msgprint(_("SMS sent to following numbers: {0}").format(
           "\n" + "\n".join(success_list)))
   return log_doc and log_doc or success_list
 
 
+def get_receiver_batches(ss, receivers):
+  """
+  SMS Providers in bulk mode take up to max_batch_size receivers in a single request,
+  the rest take one receiver per request
+  """
+  if not cint(ss.get("bulk_mode")):
+    return [[d] for d in receivers]
+  return get_chunks(receivers, max(cint(ss.get("max_batch_size")), 1))
+
+
+def encode_receivers(ss, receivers):
+  """
+  Encodes a batch of receivers as the value of the receiver_parameter
+  - Separator: joined by receiver_separator
+  - JSON Array: a list in JSON request bodies, a JSON string otherwise
+  """
+  if not cint(ss.get("bulk_mode")):
+    return receivers[0]
+
+  if ss.get("receiver_encoding") == "JSON Array":
+    if ss.use_post and ss.get("request_as_json") and "%(" not in ss.sms_gateway_url:
+      return list(receivers)
+    return json.dumps(receivers)
+
+  return (ss.get("receiver_separator") or ",").join(receivers)
+
+
+def _get_sent_receivers(ss, receivers, response, is_sms_sent=None):
+  """
+  is_sms_sent receives the response of the whole batch,
+  and can return the list of the receivers sent to when only some of them were
+  """
+  sms_sent = is_sms_sent(response, ss) if is_sms_sent else None
+  if isinstance(sms_sent, (list, tuple, set)):
+    return [d for d in receivers if d in sms_sent]
+  if (sms_sent is None and 200 <= response.status_code < 300) or sms_sent:
+    return list(receivers)
+  return []
+
+
+def _get_gateway_args(ss, message):
+  args = {ss.message_parameter: re.sub(
+      r'\s+', ' ', safe_decode(message))}
+  for hp in ss.get("parameters"):
+    if not hp.header:
+      args[hp.parameter] = hp.value
+  return args
+
+
+def _get_gateway_request(ss, args, receiver):
+  """
+  Returns (url, params) of the request to the gateway for the receiver,
+  or the encoded batch of receivers in bulk mode
+  """
+  args = dict(args)
+  args[ss.receiver_parameter] = receiver
+  url = ss.sms_gateway_url
+  if "%(" in url:
+    return ss.sms_gateway_url % args, {}
+  return url, args
+
+
+def send_gateway_requests(ss, gateway_requests):
+  """
+  Sends the requests to the SMS Provider over a bounded thread pool
+  sharing the keep-alive session of the provider
+  Only the HTTP calls are made in the threads
+
+  Returns the responses in the same order as the requests,
+  with the exception in place of the response of a failed request
+  """
+  from concurrent.futures import ThreadPoolExecutor
+
+  if not len(gateway_requests):
+    return []
+
+  session = get_sms_session(ss.name)
+  headers = get_headers(ss)
+
+  timeout = (SMS_CONNECT_TIMEOUT, cint(frappe.conf.get("sms_timeout")) or SMS_TIMEOUT)
+
+  def _send(request):
+    url, params = request
+    started = time.time()
+    try:
+      response = send_request(url, params, headers, ss.use_post, ss.get('request_as_json'),
+                              request_as_params=ss.request_as_params, session=session,
+                              timeout=timeout)
+    except Exception as exc:
+      response = exc
+    return response, time.time() - started
+
+  max_workers = min(len(gateway_requests), cint(
+      frappe.conf.get("sms_max_workers")) or SMS_MAX_WORKERS)
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    results = list(executor.map(_send, gateway_requests))
+
+  record_requests(ss.name, [(not is_gateway_error(r), elapsed) for r, elapsed in results])
+  return [r for r, elapsed in results]
+
+
+def is_gateway_error(response):
+  """
+  The gateway could not be reached, timed out or failed on its side
+  """
+  return isinstance(response, Exception) or response.status_code >= 500
+
+
+def get_sms_session(provider):
+  import requests
+  key = (frappe.local.site, provider)
+  if key not in _sessions:
+    _sessions[key] = requests.Session()
+  return _sessions[key]
+
+
+def route_receivers(receivers, providers, tried=None, probe_open=True):
+  """
+  Selects the SMS Provider of every receiver from the routing table of the providers
+  Providers with an open circuit and the ones already tried for the receiver are skipped,
+  unless probe_open is set and there is no other, when an open one is tried as a half-open probe
+
+  Returns ({ provider: [receivers] }, error_message)
+  """
+  routing_table = get_sms_routing_table(providers)
+  health = get_providers_health(set(p for routes in routing_table.values() for p, w in routes))
+  tried = tried or {}
+  now = get_time(nowtime())
+  provider_wise_receivers = frappe._dict()
+  error_message = []
+  for d in receivers:
+    country_code = _get_country_code(d)
+    routes = routing_table.get(country_code)
+    if routes is None:
+      routes = routing_table.get("all")
+    if routes is None:
+      error_message.append(_("Provider not found for {}").format(d))
+      continue
+    selected_provider = _select_provider(routes, now, health=health, exclude=tried.get(d),
+                                         probe_open=probe_open)
+    if not selected_provider and any(health[p].is_open for p, w in routes if p not in (tried.get(d) or ())):
+      error_message.append(_("SMS Provider circuit is open, try again later. For {}").format(d))
+      continue
+    elif not selected_provider and tried.get(d):
+      error_message.append(_("No other SMS Provider to fail over to for {}").format(d))
+      continue
+    elif not selected_provider:
+      error_message.append(
+          _("SMS Provider doesn't allow to send SMS now due to time restriction. For {}").format(d))
+      continue
+    provider_wise_receivers.setdefault(selected_provider, []).append(d)
+
+  return provider_wise_receivers, error_message
+
+
+def _select_provider(routes, now, health=None, exclude=None, probe_open=False):
+  """
+  The first provider allowed now, skipping the excluded ones and the ones with an open circuit
+  Slow providers are selected only when there is no other,
+  and with probe_open, the ones with an open circuit after them
+  """
+  slow_provider = None
+  open_provider = None
+  for provider, windows in routes:
+    if exclude and provider in exclude:
+      continue
+    if len(windows) and not any(from_time <= now <= to_time for from_time, to_time in windows):
+      continue
+    h = health.get(provider) if health else None
+    if h and h.is_open:
+      open_provider = open_provider or provider
+      continue
+    if h and h.is_slow:
+      slow_provider = slow_provider or provider
+      continue
+    return provider
+
+  return slow_provider or (open_provider if probe_open else None)
+
+
+def get_sms_routing_table(providers):
+  """
+  The routing table of a provider configuration, compiled once and cached in redis
+  until an SMS Provider changes
+    { country_code: [(provider, [(from_time, to_time)])] }
+  """
+  providers = [((x.get("code") or "all").lower(), x.get("provider")) for x in providers or []]
+  key = _get_routing_key(providers)
+  return frappe.cache().hget(SMS_ROUTING_TABLE_KEY, key,
+                             generator=lambda: compile_sms_routing_table(providers))
+
+
+def compile_sms_routing_table(providers):
+  """
+  Disabled providers are left out and the timing windows are parsed in advance
+
+  :param providers: [(country_code, provider)] in the order of preference
+  """
+  routing_table = {}
+  for code, provider in providers:
+    routes = routing_table.setdefault(code, [])
+    ss = frappe.get_cached_doc("SMS Provider", provider)
+    if not ss.enabled:
+      continue
+    routes.append((provider, [(get_time(t.from_time), get_time(t.to_time))
+                              for t in ss.get("timing") or []]))
+  return routing_table
+
+
+def clear_sms_routing_table():
+  frappe.cache().delete_key(SMS_ROUTING_TABLE_KEY)
+
+
+def _get_routing_key(providers):
+  import hashlib
+  return hashlib.sha1(frappe.safe_encode(json.dumps(providers))).hexdigest()
+
+
 def _get_country_code(number):
+  digits = number[1:] if number[0] == "+" else number
+  # Country calling codes are prefix free and at most 3 digits long
+  for i in range(1, 4):
+    region = _get_region_for_calling_code(digits[:i])
+    if region:
+      return region
+
   number = f"+{number}" if number[0] != "+" else number
   return region_code_for_country_code(parse_phone_number(number=number).country_code).lower()
 
 
-def _get_provider_validate_data(provider):
-  country_wise_provider = frappe._dict()
-  provider_wise_time = frappe._dict()
-  for x in provider or []:
-    key = x.get("code") or "all"
-    country_wise_provider.setdefault(key.lower(), []).append(x.get("provider"))
-    provider_wise_time.setdefault(
-        x.get("provider"), frappe.get_cached_doc("SMS Provider", x.get("provider")).get("timing") or [])
-  return country_wise_provider, provider_wise_time
+@lru_cache(maxsize=1024)
+def _get_region_for_calling_code(prefix):
+  # Calling codes never start with 0, int() would turn local numbers like 07911... into 7
+  if not prefix.isdigit() or prefix[0] == "0":
+    return None
+  region = region_code_for_country_code(int(prefix))
+  if region == UNKNOWN_REGION:
+    return None
+  return region.lower()
 
 
 def send_request(gateway_url, params, headers=None, use_post=False, request_as_json=False,
-                 request_as_params=False):
+                 request_as_params=False, session=None, timeout=None):
   import requests
 
+  session = session or requests
   if not headers:
     headers = get_headers()
   if use_post:
     if request_as_json:
-      response = requests.post(gateway_url, headers=headers, json=params)
+      response = session.post(gateway_url, headers=headers, json=params, timeout=timeout)
     elif request_as_params:
-      response = requests.post(gateway_url, headers=headers, params=params)
+      response = session.post(gateway_url, headers=headers, params=params, timeout=timeout)
     else:
-      response = requests.post(gateway_url, headers=headers, data=params)
+      response = session.post(gateway_url, headers=headers, data=params, timeout=timeout)
   else:
-    response = requests.get(gateway_url, headers=headers, params=params)
+    response = session.get(gateway_url, headers=headers, params=params, timeout=timeout)
 
   return response
 
@@ -200,15 +450,9 @@ def get_sms_recipients_for_notification(notification, doc, context=None):
       if doc.get(row.field_name):
         recipients.append(doc.get(row.field_name))
     elif row.target_type == "User" and row.get("target_user"):
-      user = frappe.get_cached_doc("User", row.get("target_user"))
-      if user.mobile_no or user.phone:
-        recipients.append(user.mobile_no or user.phone)
+      recipients.extend(get_user_mobile_nos([row.get("target_user")]))
     elif row.target_type == "Role" and row.get('target_role'):
-      mobiles = frappe.db.sql(""" select distinct coalesce(usr.mobile_no, usr.phone) from tabUser usr
-      right join `tabHas Role` hr on hr.parent=usr.name
-      where hr.role="{}" and hr.parenttype="User" and coalesce(usr.mobile_no, usr.phone, "") != ""
-      """.format(row.get('target_role')))
-      recipients.extend([x[0] for x in mobiles])
+      recipients.extend(set(get_user_mobile_nos(get_role_users([row.get('target_role')]))))
     elif row.target_type == "cmd":
       try:
         attr = frappe.get_attr(row.get("cmd"))
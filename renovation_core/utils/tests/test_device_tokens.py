@@ -0,0 +1,59 @@
+import unittest
+
+import frappe
+
+from ..device_tokens import _get_index_key, delete_tokens, get_chunks, get_indexed_tokens, \
+    get_valid_tokens, rebuild_token_index
+
+
+class TestDeviceTokens(unittest.TestCase):
+  def setUp(self):
+    self.tokens = []
+    for token, linked_sid in (("test-device-token-valid", None),
+                              ("test-device-token-stale", "invalid-sid")):
+      self.tokens.append(frappe.get_doc(frappe._dict(
+          doctype="FCM User Token",
+          user="Administrator",
+          token=token,
+          linked_sid=linked_sid
+      )).insert(ignore_permissions=True))
+
+  def tearDown(self):
+    delete_tokens("FCM User Token", names=[x.name for x in self.tokens])
+
+  def test_get_chunks(self):
+    self.assertEqual(get_chunks(range(5), 2), [[0, 1], [2, 3], [4]])
+    self.assertEqual(get_chunks(None, 2), [])
+
+  def test_get_valid_tokens(self):
+    r = get_valid_tokens("FCM User Token", users=["Administrator"])
+    self.assertIn("test-device-token-valid", r.tokens)
+    self.assertIn("test-device-token-valid", r.user_tokens.Administrator)
+    self.assertNotIn("test-device-token-stale", r.tokens)
+    self.assertIn("test-device-token-stale", r.stale_tokens)
+
+  def test_get_valid_tokens_for_roles(self):
+    r = get_valid_tokens("FCM User Token", roles=["Administrator"])
+    self.assertIn("test-device-token-valid", r.tokens)
+
+  def test_delete_tokens(self):
+    delete_tokens("FCM User Token", tokens=["test-device-token-stale"])
+    self.assertFalse(frappe.db.exists("FCM User Token", self.tokens[1].name))
+
+  def test_token_index(self):
+    rebuild_token_index("FCM User Token")
+
+    r = get_indexed_tokens("FCM User Token", ["Administrator"])
+    self.assertIn("test-device-token-valid", r.tokens)
+    self.assertIn("test-device-token-stale", r.stale_tokens)
+
+    # an evicted user is indexed again from the database
+    pipe = frappe.cache().pipeline()
+    pipe.delete(_get_index_key("FCM User Token", "Administrator"))
+    pipe.execute()
+    r = get_indexed_tokens("FCM User Token", ["Administrator"])
+    self.assertIn("test-device-token-valid", r.tokens)
+
+    delete_tokens("FCM User Token", tokens=["test-device-token-valid"])
+    r = get_indexed_tokens("FCM User Token", ["Administrator"])
+    self.assertNotIn("test-device-token-valid", r.tokens)
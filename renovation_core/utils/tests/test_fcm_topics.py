@@ -0,0 +1,16 @@
+import unittest
+
+import frappe
+
+from ..fcm_topics import get_role_topic, get_topic_conditions
+
+
+class TestFCMTopics(unittest.TestCase):
+  def test_get_role_topic(self):
+    prefix = frappe.conf.get("fcm_topic_prefix") or ""
+    self.assertEqual(get_role_topic("Sales User"), prefix + "role_Sales_User")
+
+  def test_get_topic_conditions(self):
+    conditions = get_topic_conditions(["a", "b", "c", "d", "e", "f", "a"])
+    self.assertEqual(len(conditions), 2)
+    self.assertEqual(conditions[1], "'f' in topics")
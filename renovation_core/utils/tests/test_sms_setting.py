@@ -0,0 +1,48 @@
+import unittest
+from datetime import time
+
+import frappe
+from phonenumbers import NumberParseException
+
+from ..sms_setting import _get_country_code, _get_region_for_calling_code, _select_provider, \
+    validate_receiver_nos
+
+
+class TestSMSSetting(unittest.TestCase):
+  def test_get_country_code(self):
+    self.assertEqual(_get_country_code("+97455555555"), "qa")
+    self.assertEqual(_get_country_code("96555555555"), "kw")
+    self.assertEqual(_get_country_code("+14155550100"), "us")
+
+  def test_get_country_code_leading_zero(self):
+    self.assertIsNone(_get_region_for_calling_code("07"))
+    self.assertIsNone(_get_region_for_calling_code("044"))
+    self.assertRaises(NumberParseException, _get_country_code, "07911123456")
+
+  def test_validate_receiver_nos(self):
+    r = validate_receiver_nos(["+974 5555-5555", "+974(5555)5555", "974 5555 abc", ""])
+    self.assertEqual(len(r), 1)
+    self.assertEqual(r[0].lstrip("+"), "97455555555")
+
+  def test_select_provider(self):
+    routes = [("Night", [(time(0, 0), time(6, 0))]), ("Default", [])]
+    self.assertEqual(_select_provider(routes, time(3, 0)), "Night")
+    self.assertEqual(_select_provider(routes, time(12, 0)), "Default")
+    self.assertIsNone(_select_provider(routes[:1], time(12, 0)))
+
+  def test_select_provider_failover(self):
+    routes = [("Primary", []), ("Backup", []), ("Slow", [])]
+    health = {
+        "Primary": frappe._dict(is_open=True, is_slow=False),
+        "Slow": frappe._dict(is_open=False, is_slow=True)
+    }
+    routes = [routes[2], routes[0], routes[1]]
+    self.assertEqual(_select_provider(routes, time(12, 0), health=health), "Backup")
+    self.assertEqual(_select_provider(routes, time(12, 0), health=health, exclude={"Backup"}), "Slow")
+
+    # a provider with an open circuit is probed only when there is no other
+    primary = [("Primary", [])]
+    self.assertIsNone(_select_provider(primary, time(12, 0), health=health))
+    self.assertEqual(_select_provider(primary, time(12, 0), health=health, probe_open=True), "Primary")
+    self.assertEqual(_select_provider(routes, time(12, 0), health=health,
+                                      exclude={"Backup", "Slow"}, probe_open=True), "Primary")